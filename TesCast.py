@@ -0,0 +1,122 @@
+"""
+ TesCast - What the surplus is likely to be, from TesSense's own history
+ Keeps a moving average of the surplus for every quarter hour of the day in
+ each season, updated in constant time with every reading TesSense publishes,
+ and plans from it when charging should start and stop, how many kWh the sun
+ should still give the car before it leaves, and when to top up from the grid
+ if that won't reach its limit. Saved as JSON, seeded from TesLog's database.
+
+    python3 TesCast.py                                   Today's profile and plan from tessense.json
+    python3 TesCast.py --db tessense.db --level 40       Rebuilt from the recorded history
+    python3 TesCast.py --at "2024-06-21 18:00"           Planned as if it were then
+"""
+
+import argparse, json, os, sqlite3, time
+from collections import namedtuple
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+from TesOut import flushing
+
+SLOT = 900                                                  # Seconds of the day in each bin
+DAYS = 14                                                   # Days of history each bin mostly remembers
+MAX_GAP = 300                                               # Seconds a sample counts for at most
+SEASONS = 4                                                 # Dec-Feb, Mar-May, Jun-Aug, Sep-Nov
+
+Plan = namedtuple('Plan', 'start end solar_kwh needed_kwh topup_at leave')  # Hours, hours, kWh, kWh, epoch or None, epoch
+
+
+def season(local): return local.month % 12 // 3
+
+def slot(local): return (local.hour * 3600 + local.minute * 60 + local.second) // SLOT
+
+
+class Profile:                                              # Season -> slot -> [mean watts, seconds seen]
+    def __init__(self, zone, days=DAYS, bins=None):
+        self.zone, self.days = zone, days
+        self.bins = bins or [[[0.0, 0.0] for _ in range(86400 // SLOT)] for _ in range(SEASONS)]
+        self.last = None                                    # Epoch of the previous sample
+
+    def add(self, t, watts):                                # One sample, the bin it falls in moves toward it
+        gap, self.last = min(t - self.last, MAX_GAP) if self.last else 0, t
+        if gap <= 0: return
+        local = datetime.fromtimestamp(t, self.zone)
+        cell = self.bins[season(local)][slot(local)]
+        cell[1] += gap                                      # A plain average until there's DAYS of it,
+        cell[0] += gap / min(cell[1], self.days * SLOT) * (watts - cell[0])   #  then an exponential one
+
+    def ready(self, local):                                 # A full day seen in this season
+        return all(seen >= SLOT / 2 for _, seen in self.bins[season(local)])
+
+    def expected(self, local): return self.bins[season(local)][slot(local)][0]
+
+    def plan(self, now, minwatts, maxwatts, needed_kwh, departure):   # None until the season's been seen
+        local = datetime.fromtimestamp(now, self.zone)
+        if not self.ready(local): return None
+        midnight = local.replace(hour=0, minute=0, second=0, microsecond=0)
+        sunny = [n for n, (watts, _) in enumerate(self.bins[season(local)]) if watts >= minwatts]
+        start, end = (sunny[0] * SLOT / 3600, (sunny[-1] + 1) * SLOT / 3600) if sunny else (0, 0)
+
+        leave = midnight + timedelta(hours=departure)       # The next departure, tomorrow's once today's has gone
+        if leave <= local: leave += timedelta(days=1)
+        solar_kwh, at = 0.0, local
+        while at < leave:                                   # What the charger can take of each slot's surplus
+            watts = self.expected(at)
+            if watts >= minwatts: solar_kwh += min(watts, maxwatts) * SLOT / 3.6e6
+            at += timedelta(seconds=SLOT)
+        short = needed_kwh - solar_kwh                      # Top up at the full rate as late as will still make it
+        topup_at = leave.timestamp() - short / maxwatts * 3.6e6 if short > 0 and maxwatts else None
+        return Plan(start, end, solar_kwh, needed_kwh, topup_at, leave.timestamp())
+
+    def dump(self): return json.dumps({'days': self.days, 'bins': self.bins})   # On the loop, which changes the bins
+
+    def save(self, path, text=None):                        # Whole file or nothing, a crash can't leave half of it
+        with open(path + '.tmp', 'w') as f: f.write(text or self.dump())
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def open(cls, path, zone, db=None):                     # From the JSON, else the recorded history, else empty
+        if path and os.path.exists(path):
+            with open(path) as f: saved = json.load(f)
+            return cls(zone, saved['days'], saved['bins'])
+        profile = cls(zone)
+        if db and os.path.exists(db):
+            history = sqlite3.connect(db)
+            for t, budget in history.execute("SELECT t, solar - load + volts * amps + plugs FROM samples ORDER BY t"):
+                if budget is not None: profile.add(t, budget)   # What TesSense had to share out, as it publishes
+            history.close()
+        return profile
+
+    async def run(self, path, every=900, failed=None):      # Task to save the profile now and then, and what was
+        await flushing(self.dump, lambda text: self.save(path, text), every, failed=failed)   #  learnt when TesSense stops
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the surplus profile TesSense plans charging from")
+    parser.add_argument('--profile', default='tessense.json')
+    parser.add_argument('--db', help="Rebuild the profile from TesLog's history instead")
+    parser.add_argument('--level', type=int, default=50, help="Battery level now")
+    parser.add_argument('--limit', type=int, default=90)
+    parser.add_argument('--battery', type=float, default=75, help="Battery kWh")
+    parser.add_argument('--amps', type=int, default=32)
+    parser.add_argument('--volts', type=int, default=240)
+    parser.add_argument('--minrate', type=int, default=2)
+    parser.add_argument('--departure', type=float, default=7.5, help="Hour the car leaves, 7.5 for 7:30")
+    parser.add_argument('--at', help="Plan as if it were 'YYYY-MM-DD HH:MM', defaults to now")
+    parser.add_argument('--tz', default='US/Pacific')
+    args = parser.parse_args()
+
+    zone = ZoneInfo(args.tz)
+    profile = Profile.open(None if args.db else args.profile, zone, args.db)
+    now = datetime.strptime(args.at, "%Y-%m-%d %H:%M").replace(tzinfo=zone).timestamp() if args.at else time.time()
+    local = datetime.fromtimestamp(now, zone)
+    print("Hour   " + "".join("%6d" % (n * SLOT // 60) for n in range(3600 // SLOT)) + "  minutes, expected surplus watts")
+    for hour in range(24):
+        cells = profile.bins[season(local)][hour * 3600 // SLOT:(hour + 1) * 3600 // SLOT]
+        print("%02d:00  " % hour + "".join("%6d" % watts if seen else "     -" for watts, seen in cells))
+    plan = profile.plan(now, args.minrate * args.volts, args.amps * args.volts,
+                        max(0, args.limit - args.level) / 100 * args.battery, args.departure)
+    if plan is None: print("Not enough history for this season yet")
+    else:
+        print("Charge from %02d:%02d to %02d:%02d, %.1f kWh of solar expected before leaving, %.1f kWh needed" %
+              (plan.start, plan.start % 1 * 60, plan.end, plan.end % 1 * 60, plan.solar_kwh, plan.needed_kwh))
+        if plan.topup_at: print("Top up from the grid at", datetime.fromtimestamp(plan.topup_at, zone).strftime("%a %H:%M"))
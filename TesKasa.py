@@ -0,0 +1,268 @@
+"""
+ TesKasa - Kasa plugs over the LAN, without TP-Link's cloud in the way
+ Talks to each plug's own protocol on TCP 9999, JSON scrambled with an XOR
+ autokey starting at 171 behind a 4 byte length. Finds plugs by a UDP broadcast,
+ keeps one connection open to each, and asks for the relay state and emeter in
+ a single request. Looks enough like tplinkcloud for CheckTPLink() to use either,
+ and keeps working when the internet doesn't.
+
+    python3 TesKasa.py list                              Plugs found on the LAN and what they draw
+    python3 TesKasa.py list --host 192.168.1.50          Also one the broadcast doesn't reach
+    python3 TesKasa.py serve --plugs Heater:1500,TV:150  Fake plugs on this machine to test against
+    python3 TesKasa.py list --broadcast 127.0.0.1        ... and find them
+"""
+
+import argparse, asyncio, json, socket, struct, types
+
+PORT = 9999                                                 # Every plug listens here, TCP and UDP
+KEY = 171                                                   # First byte of the XOR autokey
+BROADCAST = '255.255.255.255'                               # Where discovery is sent
+DISCOVER_WAIT = 2                                           # Seconds to listen for plugs answering it
+TIMEOUT = 5                                                 # Seconds for each request before the connection is dropped
+SYSINFO = {'system': {'get_sysinfo': {}}}
+STATUS = {'system': {'get_sysinfo': {}}, 'emeter': {'get_realtime': {}}}   # Relay and emeter in one round trip
+
+
+def encrypt(text):
+    key, out = KEY, bytearray()
+    for byte in text.encode():
+        key ^= byte                                         # Each byte is the key for the next
+        out.append(key)
+    return bytes(out)
+
+def decrypt(data):
+    key, out = KEY, bytearray()
+    for byte in data:
+        out.append(key ^ byte)
+        key = byte
+    return out.decode()
+
+def frame(message):                                         # For TCP, UDP goes without the length
+    data = encrypt(json.dumps(message))
+    return struct.pack('>I', len(data)) + data
+
+def address(host):                                          # "192.168.1.50" or "192.168.1.50:9999"
+    host, _, port = str(host).partition(':')
+    return host, int(port or PORT)
+
+def usage(realtime):                                        # Newer firmware reports milli units, older plain ones
+    if 'power_mw' in realtime:
+        return types.SimpleNamespace(power_mw=realtime['power_mw'], voltage_mv=realtime['voltage_mv'],
+                                     current_ma=realtime['current_ma'], total_wh=realtime['total_wh'])
+    return types.SimpleNamespace(power_mw=realtime['power'] * 1000, voltage_mv=realtime['voltage'] * 1000,
+                                 current_ma=realtime['current'] * 1000, total_wh=realtime['total'] * 1000)
+
+
+class Link:                                                 # One connection to a plug, kept open, one request at a time
+    def __init__(self, host, port=PORT):
+        self.host, self.port = host, port
+        self.reader = self.writer = None
+        self.lock = asyncio.Lock()
+
+    async def request(self, message):                       # A reused connection the plug dropped is opened again once
+        async with self.lock:
+            while True:
+                reused = self.writer is not None
+                try:
+                    if not reused:
+                        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), TIMEOUT)
+                    self.writer.write(frame(message))
+                    await self.writer.drain()
+                    size, = struct.unpack('>I', await asyncio.wait_for(self.reader.readexactly(4), TIMEOUT))
+                    return json.loads(decrypt(await asyncio.wait_for(self.reader.readexactly(size), TIMEOUT)))
+                except (OSError, EOFError, asyncio.TimeoutError):   # IncompleteReadError is an EOFError
+                    self.close()
+                    if not reused: raise
+
+    def close(self):
+        if self.writer: self.writer.close()
+        self.reader = self.writer = None
+
+
+class LocalPlug:                                            # Looks like a tplinkcloud device to CheckTPLink()
+    def __init__(self, link, sysinfo, child=None):
+        self.link, self.child_id = link, child and child_id(sysinfo, child)
+        self.device_id = self.child_id or sysinfo['deviceId']
+        self.device_info = types.SimpleNamespace(alias=(child or sysinfo)['alias'], status=1, model=sysinfo.get('model'),
+                                                 host=link.host, feature=sysinfo.get('feature', ''))
+        self.asking = None                                  # The status request in flight, shared by whoever wants it
+
+    def get_alias(self): return self.device_info.alias
+
+    def has_emeter(self): return 'ENE' in self.device_info.feature
+
+    def context(self, message): return dict(message, context={'child_ids': [self.child_id]}) if self.child_id else message
+
+    async def status(self):                                 # is_off() and the emeter asked together cost one request
+        if self.asking is None or self.asking.done():
+            self.asking = asyncio.ensure_future(self.link.request(self.context(STATUS)))
+        return await asyncio.shield(self.asking)
+
+    async def is_on(self):
+        sysinfo = (await self.status())['system']['get_sysinfo']
+        if self.child_id: return next(c['state'] for c in sysinfo['children'] if child_id(sysinfo, c) == self.child_id) == 1
+        return sysinfo['relay_state'] == 1
+
+    async def is_off(self): return not await self.is_on()
+
+    async def get_power_usage_realtime(self):               # None if the plug has no emeter
+        realtime = (await self.status())['emeter']['get_realtime']
+        return None if realtime.get('err_code') else usage(realtime)
+
+    async def power_on(self): await self.switch(1)
+
+    async def power_off(self): await self.switch(0)
+
+    async def switch(self, state):
+        answer = (await self.link.request(self.context({'system': {'set_relay_state': {'state': state}}})))['system']
+        if answer['set_relay_state'].get('err_code'): raise RuntimeError(self.get_alias() + ": " + str(answer['set_relay_state']))
+
+def child_id(sysinfo, child):                               # Strips give the outlet's own id, or just its number
+    return child['id'] if child['id'].startswith(sysinfo['deviceId']) else sysinfo['deviceId'] + child['id']
+
+
+class LocalDeviceManager:                                   # Plugs that answer the broadcast, and any in hosts
+    def __init__(self, hosts=(), broadcast=None, wait=DISCOVER_WAIT):
+        self.hosts, self.broadcast, self.wait = [address(host) for host in hosts], broadcast, wait
+        self.links = {}                                     # (host, port) -> Link, reused after every rediscovery
+
+    def link(self, where):
+        if where not in self.links: self.links[where] = Link(*where)
+        return self.links[where]
+
+    async def discover(self):                               # (host, port) -> sysinfo of every plug that answered
+        found = {}
+
+        class Listener(asyncio.DatagramProtocol):
+            def datagram_received(self, data, where):
+                try: found[where[:2]] = json.loads(decrypt(data))['system']['get_sysinfo']
+                except (ValueError, KeyError): pass         # Not a plug, or not one that speaks this
+
+        transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            Listener, local_addr=('0.0.0.0', 0), family=socket.AF_INET, allow_broadcast=True)
+        try:
+            for _ in range(3):                              # UDP can drop a packet or two
+                transport.sendto(encrypt(json.dumps(SYSINFO)), (self.broadcast or BROADCAST, PORT))
+                await asyncio.sleep(self.wait / 3)
+        finally: transport.close()
+        return found
+
+    async def get_devices(self):
+        found = await self.discover()
+        for where in self.hosts:
+            if where in found: continue
+            try: found[where] = (await self.link(where).request(SYSINFO))['system']['get_sysinfo']
+            except (OSError, EOFError, asyncio.TimeoutError, ValueError, KeyError): pass   # Offline, left out like the cloud does
+        devices = []
+        for where, sysinfo in found.items():
+            children = sysinfo.get('children')              # A strip is one plug per outlet
+            devices += [LocalPlug(self.link(where), sysinfo, child) for child in children] if children else [LocalPlug(self.link(where), sysinfo)]
+        return devices
+
+    def close(self):
+        for link in self.links.values(): link.close()
+
+class LocalPowerTools:                                      # tplinkcloud's TPLinkDeviceManagerPowerTools, as far as it's used
+    def __init__(self, device_manager): self.device_manager = device_manager
+
+    async def get_emeter_devices(self, devices_like=None):
+        return [d for d in await self.device_manager.get_devices()
+                if d.has_emeter() and (not devices_like or devices_like.lower() in d.get_alias().lower())]
+
+
+class FakePlugs:                                            # Plugs on this machine, one port each, to test against
+    def __init__(self, plugs, host='127.0.0.1', port=PORT + 1, volts=120):
+        self.plugs, self.host, self.port, self.volts = plugs, host, port, volts  # Name -> {'on': bool, 'watts': int}
+        self.servers, self.replies, self.clients = [], {}, set()
+        self.requests = self.connections = 0
+
+    def sysinfo(self, n, name):
+        return {'alias': name, 'deviceId': 'FAKE%036d' % n, 'model': 'HS110(US)', 'feature': 'TIM:ENE',
+                'relay_state': int(self.plugs[name]['on']), 'err_code': 0}
+
+    def answer(self, n, name, message):                     # Each module asked for, as a real plug answers
+        answer = {}
+        for module, methods in message.items():
+            if module == 'context': continue
+            for method, args in methods.items():
+                if (module, method) == ('system', 'get_sysinfo'): result = self.sysinfo(n, name)
+                elif (module, method) == ('system', 'set_relay_state'):
+                    self.plugs[name]['on'] = bool(args['state'])
+                    result = {'err_code': 0}
+                elif (module, method) == ('emeter', 'get_realtime'):
+                    watts = self.plugs[name]['watts'] if self.plugs[name]['on'] else 0
+                    result = {'voltage_mv': self.volts * 1000, 'current_ma': int(watts / self.volts * 1000),
+                              'power_mw': watts * 1000, 'total_wh': 0, 'err_code': 0}
+                else: result = {'err_code': -2, 'err_msg': 'member not support'}
+                answer.setdefault(module, {})[method] = result
+        return answer
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        for n, name in enumerate(self.plugs):
+            async def serve(reader, writer, n=n, name=name):   # Stays open for as many requests as the client sends
+                self.connections += 1
+                self.clients.add(writer)
+                try:
+                    while True:
+                        size, = struct.unpack('>I', await reader.readexactly(4))
+                        message = json.loads(decrypt(await reader.readexactly(size)))
+                        self.requests += 1
+                        writer.write(frame(self.answer(n, name, message)))
+                        await writer.drain()
+                except (OSError, EOFError): pass
+                finally:
+                    self.clients.discard(writer)
+                    writer.close()
+            self.servers.append(await asyncio.start_server(serve, self.host, self.port + n))
+            self.replies[name], _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, local_addr=(self.host, self.port + n))
+
+        fake = self
+        class Discovery(asyncio.DatagramProtocol):          # Every plug answers from its own port
+            def datagram_received(self, data, where):
+                if 'get_sysinfo' not in decrypt(data): return
+                for n, name in enumerate(fake.plugs):
+                    fake.replies[name].sendto(encrypt(json.dumps({'system': {'get_sysinfo': fake.sysinfo(n, name)}})), where)
+        discovery, _ = await loop.create_datagram_endpoint(Discovery, local_addr=(self.host, PORT))
+        self.servers.append(discovery)
+
+    def close(self):
+        for server in self.servers: server.close()
+        for reply in self.replies.values(): reply.close()
+        for client in list(self.clients): client.close()
+
+
+async def listing(hosts, broadcast):
+    tools = LocalPowerTools(LocalDeviceManager(hosts, broadcast))
+    devices = await tools.get_emeter_devices()
+    if not devices: print("No Kasa plugs with an emeter answered")
+    for device, (used, off) in zip(devices, await asyncio.gather(*(asyncio.gather(
+            d.get_power_usage_realtime(), d.is_off()) for d in devices))):
+        print('{:25} {:21} {:4} {:7.1f} watts'.format(device.get_alias(), "%s:%d" % (device.link.host, device.link.port),
+                                                     "off" if off else "on", used.power_mw / 1000))
+    tools.device_manager.close()
+
+async def serving(plugs, host, port):
+    fake = FakePlugs(plugs, host, port)
+    await fake.start()
+    print("Serving", ", ".join(plugs), "on", host, "ports", port, "to", port + len(plugs) - 1, "and discovery on", PORT)
+    print("KASA_HOSTS =", ["%s:%d" % (host, port + n) for n in range(len(plugs))])
+    try: await asyncio.Event().wait()
+    finally: fake.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find and read Kasa plugs on the LAN, or pretend to be some")
+    parser.add_argument('command', choices=('list', 'serve'))
+    parser.add_argument('--host', action='append', default=[], help="Plug address to ask directly, host or host:port")
+    parser.add_argument('--broadcast', default=BROADCAST, help="Where to send discovery")
+    parser.add_argument('--plugs', default="Heater:1500,TV:150", help="Fake plugs to serve as Name:watts,...")
+    parser.add_argument('--port', type=int, default=PORT + 1, help="First fake plug's port")
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'list': asyncio.run(listing(args.host, args.broadcast))
+        else:
+            plugs = {name: {'on': True, 'watts': int(watts)} for name, watts in (p.split(':') for p in args.plugs.split(','))}
+            asyncio.run(serving(plugs, args.host[0] if args.host else '127.0.0.1', args.port))
+    except KeyboardInterrupt: pass
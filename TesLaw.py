@@ -0,0 +1,75 @@
+"""
+ TesLaw - TesSense's charging decisions with no I/O
+ decide() takes what TesSense knows about the car and the surplus and returns
+ what should happen next, settle() says whether a rate change is worth a
+ command. allocate() shares the surplus out between the car and the plugs.
+ TesSense acts on them, TesTune.py backtests and tunes them offline.
+"""
+
+from collections import namedtuple
+
+Params = namedtuple('Params', 'minrate hysteresis dwell smoothing sleep_until sleep_after',
+                    defaults=(2, 2, 300, 120, 8, 20))       # Amps, amps, seconds, seconds, hour, hour
+State = namedtuple('State', 'hour charging plugged level limit rate max_amps power_diff smoothed volts')
+Action = namedtuple('Action', 'cmd amps')                   # cmd is one of the names below
+Load = namedtuple('Load', 'name draw steps keep', defaults=(1,))   # Watts now, watts it can run at lowest first,
+                                                            #  and the share of its draw that keeps it running
+
+IDLE = Action('idle', 0)                                    # Nothing to do
+NIGHT = Action('night', 0)                                  # Outside the charging window, stop if charging
+START = Action('start', 2)                                  # Start charging at 2 amps
+STOP = Action('stop', 0)                                    # Not enough free power
+FULL = Action('full', 0)                                    # Would start but the battery is at its limit
+UNPLUGGED = Action('unplugged', 0)                          # Would start but there's no cable
+
+
+def daytime(hour, p):
+    return p.sleep_until <= hour < p.sleep_after
+
+def decide(s, p=Params()):                                  # State -> Action
+    if not daytime(s.hour, p):
+        return NIGHT
+    if not s.charging:                                      # Start on the raw surplus, as soon as it's there
+        if s.power_diff <= p.minrate * s.volts: return IDLE
+        if s.level >= s.limit: return FULL
+        if not s.plugged: return UNPLUGGED
+        return START
+    if not s.volts:
+        return IDLE
+    newrate = min(s.rate + int(s.smoothed / s.volts), s.max_amps)  # Follow the smoothed surplus
+    if newrate < p.minrate: return STOP
+    return Action('amps', newrate) if newrate != s.rate else IDLE
+
+def amp_steps(max_amps, volts, p=Params()):                 # Watts the car can be set to, off and minrate up
+    return (0,) + tuple(amps * volts for amps in range(p.minrate, max_amps + 1))
+
+def allocate(budget, loads):                                # Greedy, loads in priority order -> {name: watts}
+    shares = {}                                             # budget is surplus plus what the loads draw now
+    for load in loads:
+        if not isinstance(load, Load):                      # A tuple of loads sharing one place in line
+            split = proportion(budget, load)
+            shares.update(split)
+            budget -= sum(split.values())
+            continue
+        share = 0
+        for step in load.steps:                             # Biggest step that fits, or keeps running what's on
+            if step <= budget or step == load.draw and step * load.keep <= budget: share = step
+        shares[load.name] = share
+        budget -= share
+    return shares
+
+def proportion(budget, group):                              # Step up whichever is furthest below its biggest step
+    shares = {load.name: 0 for load in group}
+    while True:
+        fits = [(shares[load.name] / load.steps[-1], load, step) for load in group
+                for step in [next((w for w in load.steps if w > shares[load.name]), None)]
+                if step is not None and step - shares[load.name] <= budget]
+        if not fits: return shares
+        _, load, step = min(fits, key=lambda fit: fit[0])
+        budget -= step - shares[load.name]
+        shares[load.name] = step
+
+def settle(target, current, held, p=Params()):              # Is changing to target worth a command?
+    if target == current or abs(target - current) < p.hysteresis:
+        return False
+    return target < current or held >= p.dwell              # Slowing down can't wait, speeding up can
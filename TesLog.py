@@ -0,0 +1,126 @@
+"""
+ TesLog - Keeps TesSense's history in a small SQLite file and reads it back
+ TesSense hands samples, plug readings and commands to a Recorder, which holds
+ them in a ring buffer and writes them in batches from TesOut's disk thread so
+ the control loop never waits on the disk.
+
+    python3 TesLog.py daily                              Solar to car kWh for each day
+    python3 TesLog.py daily --since 2024-06-01 --until 2024-07-01
+    python3 TesLog.py export --since 2024-06-01 --step 300 > june.csv   For TesSim.py and TesTune.py
+"""
+
+import argparse, csv, sqlite3, sys, time
+from collections import deque
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+from TesOut import flushing
+
+RING = 50000                                                # Most rows held in memory if the disk stalls
+MAX_GAP = 300                                               # Seconds a sample counts for at most when integrating
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (t INTEGER PRIMARY KEY, solar INTEGER, load INTEGER, volts INTEGER,
+    smoothed INTEGER, amps INTEGER, target INTEGER, level INTEGER, plugs INTEGER);
+CREATE TABLE IF NOT EXISTS plugs (t INTEGER, alias TEXT, watts INTEGER);
+CREATE TABLE IF NOT EXISTS commands (t INTEGER, vehicle TEXT, command TEXT, value INTEGER, ok INTEGER);
+CREATE INDEX IF NOT EXISTS plugs_t ON plugs (t);
+CREATE INDEX IF NOT EXISTS commands_t ON commands (t);
+"""
+
+
+class Recorder:                                             # Append only, all writes happen on one thread
+    def __init__(self, path, ring=RING):
+        self.path, self.db = path, None
+        self.pending = {'samples': deque(maxlen=ring), 'plugs': deque(maxlen=ring), 'commands': deque(maxlen=ring)}
+        self.cars = {}                                      # Car name -> amps, target, level for the next sample
+        self.plug_watts = {}
+        self.written = 0
+
+    def sample(self, t, solar, load, volts, smoothed):      # Called for every Sense reading, cars added together
+        cars = self.cars.values()
+        self.pending['samples'].append((int(t), int(solar), int(load), int(volts), int(smoothed),
+            sum(car['amps'] for car in cars), sum(car['target'] for car in cars),
+            min((car['level'] for car in cars), default=None), int(sum(self.plug_watts.values()))))
+
+    def car(self, name, amps, target, level): self.cars[name] = {'amps': amps, 'target': target, 'level': level}
+
+    def plug(self, t, alias, watts):
+        self.plug_watts[alias] = watts
+        self.pending['plugs'].append((int(t), alias, int(watts)))
+
+    def command(self, t, vehicle, command, value, ok):
+        self.pending['commands'].append((int(t), vehicle, command, value, int(ok)))
+
+    def write(self, batches):                               # Runs on the disk thread
+        if self.db is None:
+            self.db = sqlite3.connect(self.path)
+            self.db.executescript(SCHEMA)
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO samples VALUES (?,?,?,?,?,?,?,?,?)", batches['samples'])
+            self.db.executemany("INSERT INTO plugs VALUES (?,?,?)", batches['plugs'])
+            self.db.executemany("INSERT INTO commands VALUES (?,?,?,?,?)", batches['commands'])
+        self.written += sum(len(rows) for rows in batches.values())
+
+    def take(self):                                         # Swap out everything pending for empty buffers
+        batches = self.pending
+        self.pending = {name: deque(maxlen=rows.maxlen) for name, rows in batches.items()}
+        return batches
+
+    async def run(self, every=60, failed=None):             # Task to flush the ring buffer in batches, and what's
+        await flushing(self.take, self.write, every, failed=failed)   #  left when TesSense stops
+
+
+def daily(db, since, until, zone):                          # Integrate samples into per day kWh
+    days, total, last = [], None, None
+    for t, solar, load, car, plugs in db.execute("""SELECT t, solar, load, volts * amps, plugs FROM samples
+                                                   WHERE t >= ? AND t < ? ORDER BY t""", (since, until)):
+        if last:                                            # Each sample holds until the next one
+            hours = min(t - last[0], MAX_GAP) / 3600
+            solar0, load0, car0, plugs0 = last[1:]
+            free = max(0, solar0 - (load0 - car0))          # What the solar left over for the car
+            total['solar'] += solar0 * hours / 1000
+            total['car'] += car0 * hours / 1000
+            total['car_solar'] += min(car0, free) * hours / 1000
+            total['plugs'] += plugs0 * hours / 1000
+        if total is None or t >= total['end']:              # Local midnight, wall clock math keeps DST right
+            start = datetime.fromtimestamp(t, zone).replace(hour=0, minute=0, second=0, microsecond=0)
+            total = {'day': start.strftime("%Y-%m-%d"), 'start': start.timestamp(),
+                     'end': (start + timedelta(days=1)).timestamp(), 'solar': 0.0, 'car': 0.0, 'car_solar': 0.0, 'plugs': 0.0}
+            days.append(total)
+        last = t, solar or 0, load or 0, car or 0, plugs or 0
+    for total in days:
+        total['commands'] = db.execute("SELECT count(*) FROM commands WHERE t >= ? AND t < ?",
+                                       (total['start'], total['end'])).fetchone()[0]
+    return days
+
+def export(db, since, until, step, out):                    # Averaged over step seconds, TesSim/TesTune trace first
+    writer = csv.writer(out)
+    writer.writerow(('time', 'solar', 'base_load', 'load', 'volts', 'car_watts', 'plugs', 'level'))
+    for row in db.execute("""SELECT t / ? * ?, avg(solar), avg(load - volts * amps - plugs), avg(load), avg(volts),
+                             avg(volts * amps), avg(plugs), max(level) FROM samples WHERE t >= ? AND t < ?
+                             GROUP BY t / ? ORDER BY t""", (step, step, since, until, step)):
+        writer.writerow([row[0]] + [None if v is None else round(v) for v in row[1:]])
+
+def stamp(text, zone): return datetime.strptime(text, "%Y-%m-%d").replace(tzinfo=zone).timestamp()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Read back the history TesSense has recorded")
+    parser.add_argument('report', choices=('daily', 'export'))
+    parser.add_argument('--db', default='tessense.db')
+    parser.add_argument('--since', help="YYYY-MM-DD, defaults to 30 days ago for daily and everything for export")
+    parser.add_argument('--until', help="YYYY-MM-DD, not included")
+    parser.add_argument('--step', type=int, default=60, help="Seconds to average each exported row over")
+    parser.add_argument('--tz', default='US/Pacific')
+    args = parser.parse_args()
+
+    zone = ZoneInfo(args.tz)
+    since = stamp(args.since, zone) if args.since else time.time() - 30 * 86400 if args.report == 'daily' else 0
+    until = stamp(args.until, zone) if args.until else time.time() + 86400
+    db = sqlite3.connect(args.db)
+    if args.report == 'export':
+        export(db, since, until, args.step, sys.stdout)
+    else:
+        print("Day          Solar kWh  Car kWh  From solar  From grid  Plugs kWh  Commands")
+        for d in daily(db, since, until, zone):
+            print("%s %10.1f %8.1f %11.1f %10.1f %10.1f %9d" % (d['day'], d['solar'], d['car'], d['car_solar'],
+                  d['car'] - d['car_solar'], d['plugs'], d['commands']))
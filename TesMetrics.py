@@ -0,0 +1,97 @@
+"""
+ TesMetrics - Counters, gauges and latency histograms for TesSense, served in
+ Prometheus text format from a small HTTP endpoint on the same event loop.
+ Recording is a dict lookup and a bisect, gauges are only read when scraped.
+
+    curl -s localhost:9108/metrics
+"""
+
+import asyncio
+from bisect import bisect_left
+
+LATENCY = (.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 20, 30, 60, 90)  # Seconds, API calls
+DURATION = (.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 20, 45, 90, 180)    # Seconds, loop iterations without their sleeps
+LAG = (.001, .005, .01, .05, .1, .25, .5, 1, 2.5, 5)                   # Seconds, event loop lag
+
+
+class Histogram:                                            # Cumulative only when rendered
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets, self.counts, self.sum = buckets, [0] * (len(buckets) + 1), 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Metrics:
+    def __init__(self):
+        self.kinds = {}                                     # Name -> (type, help, buckets or gauge function)
+        self.series = {}                                    # Name -> {labels: value or Histogram}
+
+    def counter(self, name, help):
+        self.kinds[name] = ('counter', help, None)
+        self.series[name] = {}
+
+    def histogram(self, name, help, buckets=LATENCY):
+        self.kinds[name] = ('histogram', help, buckets)
+        self.series[name] = {}
+
+    def gauge(self, name, help, read):                      # read() returns a number or {labels: number}
+        self.kinds[name] = ('gauge', help, read)
+
+    def inc(self, name, amount=1, **labels):
+        series, key = self.series[name], tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        series, key = self.series[name], tuple(sorted(labels.items()))
+        if key not in series: series[key] = Histogram(self.kinds[name][2])
+        series[key].observe(value)
+
+    def render(self):                                       # Prometheus text exposition format 0.0.4
+        lines = []
+        for name, (kind, help, extra) in self.kinds.items():
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            if kind == 'gauge':
+                value = extra()
+                series = value if isinstance(value, dict) else {(): value}
+            else: series = self.series[name]
+            for key, value in series.items():
+                if kind != 'histogram':
+                    lines.append("%s%s %s" % (name, labelled(key), number(value)))
+                    continue
+                total = 0
+                for bound, count in zip(value.buckets + ('+Inf',), value.counts):
+                    total += count
+                    lines.append("%s_bucket%s %d" % (name, labelled(key + (('le', number(bound)),)), total))
+                lines.append("%s_sum%s %s" % (name, labelled(key), number(value.sum)))
+                lines.append("%s_count%s %d" % (name, labelled(key), total))
+        return "\n".join(lines) + "\n"
+
+    async def respond(self, reader, writer):                # One request per connection, any path
+        try:
+            request = await asyncio.wait_for(reader.readline(), 10)
+            while (await asyncio.wait_for(reader.readline(), 10)).strip(): pass     # Skip the headers
+            if request.split(b' ')[0] == b'GET':
+                body = self.render().encode()
+                writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                             b"Content-Length: %d\r\n\r\n%s" % (len(body), body))
+            else: writer.write(b"HTTP/1.0 405 Method Not Allowed\r\nContent-Length: 0\r\n\r\n")
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError): pass
+        finally: writer.close()
+
+    async def serve(self, host, port):                      # Task to answer scrapes, next to SenseLink's
+        server = await asyncio.start_server(self.respond, host, port)
+        async with server: await server.serve_forever()
+
+def labelled(key):
+    if not key: return ""
+    return "{" + ",".join('%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+                          for k, v in key) + "}"
+
+def number(value):
+    return value if isinstance(value, str) else repr(float(value)) if isinstance(value, float) else str(int(value))
@@ -0,0 +1,115 @@
+"""
+ TesOut - TesSense's output, written without holding up the event loop
+ Whatever the tasks say goes on a bounded queue as a small event, never waiting
+ on the terminal. One task takes them off in batches, renders them as the usual
+ coloured terminal view or as one JSON object per line for journald and log
+ shippers, and writes them from the writer thread, so a slow SSH session or a
+ full pipe only ever delays the output. Messages repeated every pass can be rate
+ limited where they're said, and are then never queued at all.
+
+ The history, the forecast and the saved state are flushed by flushing() on a
+ disk thread of their own, so a stuck terminal can't hold them up either.
+"""
+
+import asyncio, json, re, sys, time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from datetime import datetime
+
+QUEUE = 1000                                                # Events held while the writer catches up, more are dropped
+ANSI = re.compile(r'\033\[[0-9;]*[A-Za-z]')                 # Colours and cursor moves
+RULE = re.compile(r'^[\s=!-]*$')                            # Lines that are only there to box things in
+TTY_ONLY = {'tick', 'screen'}                               # Progress and screen clears, nothing to log
+LAST_WAIT = 5                                               # Seconds to wait on the last words when stopping
+
+writer = ThreadPoolExecutor(1, thread_name_prefix="TesWrite")   # Every write to stdout, in order
+disk = ThreadPoolExecutor(1, thread_name_prefix="TesDisk")      # And to files, one at a time
+
+
+async def flushing(take, write, every, wait=asyncio.sleep, last=None, failed=None):  # Task to write what take()
+    loop = asyncio.get_running_loop()                       #  gathers now and then, None when there's nothing to,
+    try:                                                    #  and when it stops
+        while True:
+            await wait(every)
+            batch = take()                                  # On the loop, where what it reads is changed
+            if batch is None: continue
+            try: await loop.run_in_executor(disk, write, batch)
+            except Exception as e: (failed or complain)(e)  # A full or missing disk mustn't stop the charging
+    finally:                                                # Don't lose the last of it when TesSense stops
+        batch = (last or take)()
+        if batch is not None:
+            try: disk.submit(write, batch).result()
+            except Exception as e: (failed or complain)(e)
+
+def complain(error): print("Write failed,", repr(error), file=sys.stderr)
+
+
+class At:                                                   # Stands for when the event was said, formatted when written
+    __slots__ = ('form',)
+    def __init__(self, form): self.form = form
+
+STAMP, CLOCK = At("%a %I:%M %p"), At("%H:%M")
+
+
+class Output:
+    def __init__(self, form='auto', zone=None, clock=time, size=QUEUE):
+        self.form = form if form != 'auto' else 'tty' if sys.stdout.isatty() else 'json'
+        self.zone, self.clock = zone, clock
+        self.queue = asyncio.Queue(size)
+        self.last = {}                                      # Rate limit key -> when it was last said
+        self.partial = {}                                   # Task -> start of a line said with end='', for JSON
+        self.counts = {'written': 0, 'dropped': 0, 'limited': 0, 'failed': 0}
+        self.reported = 0                                   # Drops already owned up to
+
+    def say(self, *args, sep=' ', end='\n', kind='info', every=0, key=None, **fields):  # Like print(), but never waits
+        task = asyncio.current_task()
+        name = task.get_name() if task else None
+        if every:                                           # At most one of these every so many seconds
+            key, now = key or (name, kind), self.clock.monotonic()
+            if now - self.last.get(key, -every) < every:
+                self.counts['limited'] += 1
+                return
+            self.last[key] = now
+        try: self.queue.put_nowait((self.clock.time(), name, kind, args, sep, end, fields))
+        except asyncio.QueueFull: self.counts['dropped'] += 1
+
+    def text(self, t, args, sep, plain):                    # Arguments as print() would join them
+        if plain: return sep.join(str(a) for a in args if not isinstance(a, At))
+        return sep.join(datetime.fromtimestamp(t, self.zone).strftime(a.form) if isinstance(a, At) else str(a) for a in args)
+
+    def render(self, event):
+        t, task, kind, args, sep, end, fields = event
+        if self.form == 'tty': return self.text(t, args, sep, False) + end
+        if kind in TTY_ONLY: return ''
+        line = self.partial.pop(task, '') + ANSI.sub('', self.text(t, args, sep, True))
+        if '\n' not in end:                                 # Finished by a later say()
+            self.partial[task] = line + end
+            return ''
+        message = "\n".join(part.strip() for part in line.split("\n") if not RULE.match(part))
+        if not message and not fields: return ''
+        return json.dumps(dict(time=datetime.fromtimestamp(t, self.zone).isoformat(timespec='seconds'),
+                               task=task, kind=kind, msg=message, **fields), default=str) + "\n"
+
+    def take(self, *events):                                # Those and everything queued after them, rendered
+        events = list(events)
+        while not self.queue.empty(): events.append(self.queue.get_nowait())
+        if self.counts['dropped'] > self.reported:          # Say so, the writer fell behind
+            events.append((self.clock.time(), None, 'error', ("%d messages dropped" % (self.counts['dropped'] - self.reported),), ' ', '\n', {}))
+            self.reported = self.counts['dropped']
+        self.counts['written'] += len(events)
+        return "".join(self.render(event) for event in events)
+
+    def write(self, text):                                  # Runs on the writer thread
+        try:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+        except (OSError, ValueError): self.counts['failed'] += 1   # Closed or gone, keep charging regardless
+
+    async def run(self):                                    # Task to write whatever's been said, in batches
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                text = self.take(await self.queue.get())   # Wait for the first, then take it with the rest
+                if text: await loop.run_in_executor(writer, self.write, text)
+        finally:                                            # Don't lose the last words when TesSense stops,
+            try: writer.submit(self.write, self.take()).result(LAST_WAIT)   #  but don't hang on a stuck terminal
+            except TimeoutError: self.counts['failed'] += 1
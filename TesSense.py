@@ -2,7 +2,7 @@
  TesSense w/ SenseLink  -Randy Spencer 12/2023 Full Version 1.2
  Python charge monitoring utility for those who own the Sense Energy Monitor
  Uses Sense stats for production and utilization of electricity to control
- your first Tesla's AC charging to charge only with excess production.
+ your Teslas' AC charging to charge only with excess production.
  Simply plug in your car, update your info below, and type> python3 tessense.py
 
 Tesla 240v charging is reported to Sense via TP-LinkCloud for logging and display
@@ -10,7 +10,9 @@ Other KASA devices can be controlled via SenseLink using the ControlList below,
 more solar is available more devices are turned on and vice-versa
 """
 
-import asyncio, logging, sys, time
+import asyncio, functools, hashlib, importlib, json, logging, math, os, sys, threading, time, uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from zoneinfo import ZoneInfo
 TZ = ZoneInfo('US/Pacific')                                 # TimeZone name
@@ -21,6 +23,40 @@ USERNAME = 'elon@tesla.com'                                 # Sense's and TPLink
 SENSEPASS = 'sense password'                                # Sense's password, Tesla will prompt for it's own
 KASAPASS = 'TPLink password'                                # TPLink's password
 CONTROLLIST = 0 #["Lamp", "TV", "Heater"]                   # Replace '0' with a list of your devices to control
+IO_WORKERS, IO_TIMEOUT = 4, 90                              # Threads for blocking Sense/Tesla calls, seconds per call
+LAG_WARN = 0.5                                              # Report when the event loop is this many seconds late
+CACHE_TTL = 30                                              # Seconds a vehicle data snapshot is reused
+STALE_AFTER = 180                                           # Seconds before a Sense reading is too old to act on
+SENSE_STREAM = True                                         # Keep Sense's realtime websocket open instead of polling
+SMOOTHING = 120                                             # Seconds of history in the smoothed surplus
+PUBLISH_EVERY = 10                                          # Seconds between readings published from the stream
+AMP_HYSTERESIS = 2                                          # Ignore charge rate changes smaller than this many amps
+MIN_DWELL = 300                                             # Seconds to hold a rate before raising it again
+CMD_BUDGET = 30, 200                                        # Most Tesla commands to send per hour, per day
+WAKE_BUDGET = 4                                             # Most times a day to wake each car
+WAKE_SUSTAIN = 300                                          # Seconds the smoothed surplus must hold to wake a car
+IDLE_REFRESH = 1800                                         # Seconds between data fetches for an idle car, so it sleeps
+DOZE = 1200                                                 # Seconds an idle car stays up after a fetch, longer is use
+POLL = 30, 120, 1200                                        # Seconds between polls: surplus jumping, steady, nothing to do
+POLL_ALIGN = 30                                             # Polls land on multiples of this, so tasks wake together
+BACKOFF = 60, 1800                                          # Seconds after an error, doubling with each one up to the most
+NUDGE = 2                                                   # Amps the surplus can move before everyone polls at once
+VEHICLES = 0 #["Model 3", "5YJYGDEE1MF000000"]              # Replace '0' with the names or VINs of the cars to charge
+SPLIT = 'priority'                                          # Cars share surplus by 'priority' (VEHICLES order), 'soc'
+                                                            #  lowest first, or 'proportional' to their chargers
+CAR_RANK, CAR_AMPS = 0, 32                                  # Cars' place in CONTROLLIST priority, amps till it says
+KASA_GUESS = 1000                                           # Watts a plug is taken to draw until it's been seen on
+KASA_KEEP = .5                                              # Part of a running plug's draw solar must cover to keep it on
+KASA_PARALLEL = 4                                           # TPLink plugs polled at the same time
+KASA_REINDEX, KASA_RETRY = 3600, 300                        # Seconds before re-listing plugs, sooner if one's missing
+KASA_BACKEND = 'cloud'                                      # 'cloud' through TP-Link's servers, 'local' straight to the plugs
+KASA_HOSTS = 0 #["192.168.1.50", "192.168.1.51:9999"]       # Plugs the 'local' broadcast doesn't reach, '0' if it finds them all
+RECORD = 'tessense.db'                                      # SQLite file to keep history in, 0 to not record
+METRICS_HOST, METRICS_PORT = '127.0.0.1', 9108              # Prometheus metrics endpoint, port 0 to turn off
+FORECAST = 'tessense.json'                                  # Surplus profile to plan charging from, 0 for the fixed hours
+DEPARTURE, BATTERY_KWH = 7.5, 75                            # Hour the cars leave (7:30), grid tops up to the limit by then
+STATE = 'tessense_state.json'                               # Sign in tokens and what each car was doing, 0 to start afresh
+LOG_FORMAT = 'auto'                                         # 'tty' coloured, 'json' a line each for journald, 'auto' by stdout
 
 REDTXT, BLUTXT, NORMTXT = '\033[31m', '\033[34m', '\033[m'
 REDBG, GRNBG, NORMBG = '\033[101m', '\033[102m', '\033[0m'
@@ -32,7 +68,7 @@ handler = logging.StreamHandler(sys.stdout)
 
 # To install support module:
 # pip3 install sense_energy (to receive Sense data)
-from sense_energy import Senseable
+from sense_energy import Senseable, SenseAuthenticationException
 
 # pip3 install teslapy (to talk to your Tesla)
 import teslapy
@@ -42,411 +78,1107 @@ from senselink import SenseLink
 from senselink.plug_instance import PlugInstance
 from senselink.data_source import MutableSource
 
-# pip3 install tplink-cloud-api (to control to your Kasa plugs)
-from tplinkcloud import TPLinkDeviceManager, TPLinkDeviceManagerPowerTools
+# pip3 install tplink-cloud-api (to control to your Kasa plugs), imported by sign_in_kasa() only with a CONTROLLIST
+tplinkcloud = None
 
+# Kasa plugs over the LAN when KASA_BACKEND is 'local', also imported by sign_in_kasa()
+TesKasa = None
+
+# Charging decisions, kept free of I/O so TesTune.py can backtest them
+from TesLaw import Params, State, Load, decide, settle, allocate, amp_steps, daytime, NIGHT, START, STOP, FULL, UNPLUGGED
+LAW = Params(MINRATE, AMP_HYSTERESIS, MIN_DWELL, SMOOTHING, SLEEP_UNTIL, SLEEP_AFTER)
+fleet = {}                                                  # Car name -> teslapy Vehicle, in VEHICLES order
+
+# History for TesLog.py reports and TesTune.py backtests, written off the event loop
+from TesLog import Recorder
+
+# Latency histograms and counters for the metrics endpoint
+from TesMetrics import Metrics, DURATION, LAG
+
+# Surplus forecast by time of day and season, learnt from the readings
+from TesCast import Profile
+
+# Output queued and written from its own thread, as the terminal view or JSON lines
+from TesOut import Output, STAMP, CLOCK, flushing
+
+
+io_pool = ThreadPoolExecutor(IO_WORKERS, thread_name_prefix="TesSenseIO")
+io_slots = kasa_slots = None                                # Bound calls in flight to the number of threads, and TPLink
+                                                            #  polls, made in main() as Python 3.9 ties them to a loop
+loop_lag = loop_lag_max = 0                                 # Seconds the event loop woke late, last and worst
+snapshots = {}                                              # Vehicle id -> (time fetched, vehicle data)
+summarized, summary_lock = 0, None                          # When every car's summary was last fetched, main() makes the lock
+cache_stats = {'fetched': 0, 'reused': 0}                   # Vehicle data fetches made and avoided
+summary_stats = {'fetched': 0, 'reused': 0}                 # PRODUCT_LIST calls made and shared
+recorder = None                                             # TesLog Recorder when RECORD is set
+metrics = None                                              # TesMetrics when METRICS_PORT is set
+profile = None                                              # TesCast Profile when FORECAST is set
+out = None                                                  # TesOut Output, everything said goes through it
+state = {}                                                  # What's kept in STATE, tokens and each car's last known state
+launched, startup = 0, {}                                   # When main() began, startup step -> seconds
+passes = {}                                                 # Task name -> when its current pass began
+
+async def blocking(func, *args, timeout=IO_TIMEOUT, **kwargs):  # Run blocking Sense/Tesla I/O in a worker thread
+    await io_slots.acquire()                                # A call that timed out keeps its slot until it returns
+    name, start = func.__name__, time.monotonic()
+    future = asyncio.get_running_loop().run_in_executor(io_pool, functools.partial(func, *args, **kwargs))
+
+    def done(f):                                            # Runs when the call returns, even after a timeout
+        io_slots.release()
+        error = None if f.cancelled() else f.exception()    # Also marks the exception retrieved
+        if metrics: measure(name, start, error)
+    future.add_done_callback(done)
+    try: return await asyncio.wait_for(asyncio.shield(future), timeout)  # Raises asyncio.TimeoutError
+    except asyncio.TimeoutError:
+        if metrics: metrics.inc('tessense_api_timeouts_total', api=name)
+        raise
+
+async def timed(name, awaitable):                           # Measure an async API call the way blocking() does
+    start, error = time.monotonic(), None
+    try: return await awaitable
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        if metrics: measure(name, start, error)
+
+def measure(name, start, error):
+    metrics.observe('tessense_api_seconds', time.monotonic() - start, api=name)
+    if error: metrics.inc('tessense_api_errors_total', api=name, error=type(error).__name__)
+
+def begin(task): passes[task] = time.monotonic()            # A Sense reading starts a pass of a task's main loop
+
+def iterated(task):                                         # Its work's done, before it sleeps or waits for the next
+    start = passes.pop(task, None)
+    if metrics and start is not None: metrics.observe('tessense_iteration_seconds', time.monotonic() - start, task=task)
+
+def say(*args, **kwargs): out.say(*args, **kwargs)         # print() that never waits on stdout
+
+async def phase(step, awaitable):                           # Time a startup step, most of them run side by side
+    start = time.monotonic()
+    try: return await awaitable
+    finally: startup[step] = time.monotonic() - start
+
+def reached(step):                                          # Seconds from launch to a startup milestone, the first time
+    if step in startup: return
+    startup[step] = time.monotonic() - launched
+    if step == "first decision":
+        say("Started in %.1f seconds:" % startup[step], ", ".join("%s %.1fs" % each for each in startup.items()),
+            kind='startup', seconds={step: round(seconds, 2) for step, seconds in startup.items()})
+
+class SenseReading:                                         # Snapshot published by UpdateSense(), never modified
+    __slots__ = ('seq', 'stamp', 'power_diff', 'smoothed', 'variance', 'volts', 'minwatts', 'timeout', 'down', 'shares', 'shares_now')
+
+    def __init__(self, seq=0, power_diff=0, volts=0, timeout=0, down=0, smoothed=None, variance=0, shares=None, shares_now=None):
+        self.seq, self.stamp = seq, time.monotonic()        # Sequence number and when it was taken
+        self.power_diff, self.volts = power_diff, volts     # Free watts and total voltage between 2 legs
+        self.smoothed = power_diff if smoothed is None else smoothed  # Free watts averaged over SMOOTHING
+        self.variance = variance                            #  and how much it's been jumping around
+        self.minwatts = MINRATE * volts                     # Minimum watts needed to start charging
+        self.timeout = timeout                              # Sense failures in a row, power_diff is 0 if any
+        self.down = down                                    #  and seconds since the last good one
+        self.shares = shares or {}                          # Load name -> watts it may draw, from the smoothed
+        self.shares_now = shares_now or {}                  #  and from the latest surplus, none if invalid
+
+    def fresh(self):                                        # Valid data recent enough to act on
+        return self.seq > 0 and not self.timeout and time.monotonic() - self.stamp < STALE_AFTER
+
+    def offline(self):                                      # Seconds without good data, still counting if nothing's come since
+        return self.down + time.monotonic() - self.stamp
+
+class Smoother:                                             # Time weighted EWMA and variance, O(1) per sample
+    __slots__ = ('window', 'mean', 'var', 'last')
+
+    def __init__(self, window=SMOOTHING):
+        self.window, self.mean, self.var, self.last = window, None, 0.0, 0
+
+    def add(self, value, stamp):                            # Samples may arrive at any spacing
+        if self.mean is None:
+            self.mean, self.last = float(value), stamp
+            return self.mean
+        alpha = 1 - math.exp(-max(stamp - self.last, 0) / self.window)
+        diff = value - self.mean
+        self.mean += alpha * diff
+        self.var = (1 - alpha) * (self.var + alpha * diff * diff)
+        self.last = stamp
+        return self.mean
+
+loads = {}                                                  # Name -> Load, the car and plugs TesSense can turn up or down
+
+def claim(name, draw, steps, keep=1):                       # A load's draw now and what it could run at
+    loads[name] = Load(name, draw, steps, keep)
+
+def by_priority():                                          # CONTROLLIST order with the cars at CAR_RANK
+    cars = [loads[name] for name in fleet if name in loads]
+    if SPLIT == 'soc':                                      # Emptiest battery first, by 5% so close ones don't swap
+        cars.sort(key=lambda load: fleet[load.name].get('charge_state', {}).get('battery_level', 100) // 5)
+    if SPLIT == 'proportional' and cars:
+        cars = [tuple(cars)]                                # Step them up together, in proportion to their chargers
+    plugs = [loads[name] for name in CONTROLLIST or [] if name in loads]
+    return plugs[:CAR_RANK] + cars + plugs[CAR_RANK:]
+
+reading = SenseReading()                                    # Latest reading from UpdateSense()
+new_reading = None                                          # Event set, then replaced, each time a reading is published
+
+def publish(**fields):                                      # Hand a new reading to every waiting task
+    global reading, new_reading
+    reading = SenseReading(reading.seq + 1, **fields)
+    new_reading.set()
+    new_reading = asyncio.Event()
+
+async def next_reading(seen):                               # Wait for a reading newer than sequence number seen,
+    try:                                                    #  or STALE_AFTER, when the latest is too old to act on
+        while reading.seq <= seen:
+            await asyncio.wait_for(new_reading.wait(), STALE_AFTER)
+    except asyncio.TimeoutError: pass                       # Sense has gone quiet
+    return reading
+
+async def vehicle_data(car, max_age=CACHE_TTL):             # Vehicle data, only refetched once stale
+    stamp, data = snapshots.get(car['id_s'], (0, None))
+    if data is not None and time.monotonic() - stamp < max_age:
+        cache_stats['reused'] += 1
+        return data
+    data = await blocking(car.get_vehicle_data)             # Raises HTTPError when the car is asleep
+    snapshots[car['id_s']] = (time.monotonic(), data)
+    cache_stats['fetched'] += 1
+    return data
+
+def invalidate(car):                                        # A command was sent so the snapshot is out of date
+    snapshots.pop(car['id_s'], None)
+
+async def summaries(tesla):                                 # Every car's summary from one call, at most every CACHE_TTL
+    global summarized
+    async with summary_lock:                                # Cars asking at once share the one call
+        if time.monotonic() - summarized < CACHE_TTL:
+            summary_stats['reused'] += 1
+            return
+        products = (await blocking(tesla.api, 'PRODUCT_LIST'))['response']
+        for car in fleet.values():
+            for product in products:
+                if product.get('id_s') == car['id_s']:
+                    car.update(product)                     # state and in_service, as get_vehicle_summary() would
+                    car.timestamp = time.time()             #  so available() won't fetch its own
+        summarized = time.monotonic()
+        summary_stats['fetched'] += 1
+
+async def online(car):                                      # Is the car awake, going by the shared summary
+    try: await summaries(car.tesla)
+    except Exception: printmsg(REDBG + "Failed to check vehicle summaries" + NORMBG, kind='error')
+    return await blocking(car.available)                    # Fetches this car's summary if the above failed
+
+class Commander:                                            # Sits between the control logic and car.command()
+    def __init__(self, car):
+        self.car = car
+        self.changed = 0                                    # When the amps were last changed
+        self.history = deque()                              # When each command of the last day was sent
+        self.sent = self.suppressed = 0
+
+    def in_budget(self):                                    # Under both the hourly and the daily command budget
+        now = time.time()
+        while self.history and self.history[0] < now - 86400: self.history.popleft()
+        return len(self.history) < CMD_BUDGET[1] and sum(t > now - 3600 for t in self.history) < CMD_BUDGET[0]
+
+    async def send(self, cmd, err, force=False, **kwargs):  # force skips the budget, stopping and slowing must work
+        if not force and not self.in_budget():
+            self.suppressed += 1
+            say(REDTXT + "Command budget used up, not sending", cmd + NORMTXT, kind='error', command=cmd)
+            return False
+        self.history.append(time.time())
+        self.sent += 1
+        if metrics: metrics.inc('tessense_commands_total', command=cmd)
+        ok = False
+        try: await blocking(self.car.command, cmd, **kwargs)
+        except teslapy.VehicleError as e: printerror("V: " + err, e)
+        except teslapy.HTTPError as e: printerror("H: " + err, e)
+        except asyncio.TimeoutError as e: printerror("T: " + err, repr(e))
+        else: ok = True
+        finally:
+            invalidate(self.car)
+            if recorder: recorder.command(time.time(), self.car['vin'], cmd, kwargs.get('charging_amps'), ok)
+        return ok
+
+    def started(self): self.changed = time.monotonic()      # Charging began at the lowest rate, hold it there
+
+    async def set_amps(self, target, current, msg):         # Returns the amps in effect afterwards, a change held
+        if target == current: return current                #  back is asked for again with the next pass's target
+        if not settle(target, current, time.monotonic() - self.changed, LAW):  # Hysteresis and dwell time
+            self.suppressed += 1
+            return current
+        say(msg, "charging to", target, "amps", kind='command', amps=target)
+        newrate = 1 if target == 2 else target              # For API a newrate of 3=3, 2=3, 1=2
+        slower = target < current                           # Over budget or not, don't keep drawing from the grid
+        if not await self.send('CHARGING_AMPS', "Failed to change", slower, charging_amps=newrate):
+            return current                                  #  so to set to 2 newrate must be 1
+        if newrate < 5:                                     # if under 5 amps you also need to
+            await self.send('CHARGING_AMPS', "Failed to change 2", slower, charging_amps=newrate)  # send it twice:
+        self.changed = time.monotonic()
+        return target
+
+commanders = {}                                             # Vehicle id -> Commander
+
+def commander(car):
+    if car['id_s'] not in commanders: commanders[car['id_s']] = Commander(car)
+    return commanders[car['id_s']]
+
+class Tracker:                                              # What each car was last seen doing, so it can sleep
+    def __init__(self, car):
+        self.car = car
+        self.seen = None                                    # When vehicle data was last fetched, None if unsure
+        self.seen_at = None                                 #  and as an epoch, for STATE
+        self.up = None                                      # When the summary last said it was awake
+        self.charging, self.plugged, self.home = False, True, True  # Worth a look until a snapshot says otherwise
+        self.level, self.limit = 0, 100
+        self.since = None                                   # When the smoothed share first covered minwatts
+        self.wanted = False                                 # Waking at the first sign of surplus would have
+        self.wakes = deque()                                # When each wake of the last day happened
+        self.woken = self.avoided = 0
+
+    def update(self, chargedata, home):                     # From every vehicle data snapshot
+        self.charging = chargedata['charging_state'] == "Charging"
+        self.plugged = chargedata['charging_state'] != "Disconnected"
+        self.level, self.limit = chargedata['battery_level'], chargedata['charge_limit_soc']
+        self.home, self.seen, self.seen_at = home, time.monotonic(), time.time()
+
+    def saw(self, awake):                                   # From every summary, forget what may have changed
+        if awake: self.up = time.monotonic()
+        else:
+            if self.up and self.seen and self.up - self.seen > DOZE: self.seen = None   # Up unwatched, driven or
+            self.up = None                                  #  plugged in maybe
+
+    def why_not(self):                                      # Why the car can't charge, None if it can or might
+        if self.seen is None: return None
+        if not (self.home and self.plugged) and self.unseen() > IDLE_REFRESH * 2 ** len(self.wakes): return None
+        if not self.home: return "Away"                     # Coming home or plugging in wakes the car, but a summary
+        if not self.plugged: return "Unplugged"             #  can miss it, so look again less often each wake
+        if self.level >= self.limit: return "Full"
+
+    def unseen(self): return math.inf if self.seen is None else time.monotonic() - self.seen
+
+    def stale(self): return self.unseen() > IDLE_REFRESH
+
+    def remember(self):                                     # For STATE, times as epochs to outlast a restart
+        return {'at': None if self.seen is None else self.seen_at,
+                'charging': self.charging, 'plugged': self.plugged, 'home': self.home,
+                'level': self.level, 'limit': self.limit, 'wakes': list(self.wakes)}
+
+    def restore(self, saved, fresh):                        # From STATE, what was seen only if nothing was missed since
+        now = time.time()                                   # Nothing from the future, the clock may be behind
+        self.wakes.extend(t for t in saved.get('wakes', ()) if now - 86400 < t <= now)
+        if not fresh or saved.get('at') is None: return
+        self.charging, self.plugged, self.home = saved['charging'], saved['plugged'], saved['home']
+        self.level, self.limit = saved['level'], saved['limit']
+        self.seen_at = min(saved['at'], now)
+        self.seen = time.monotonic() - (now - self.seen_at)
+
+    def in_budget(self):
+        now = time.time()
+        while self.wakes and self.wakes[0] < now - 86400: self.wakes.popleft()
+        return len(self.wakes) < WAKE_BUDGET
+
+    def woke(self):                                         # Count a wake, False if the budget's used up
+        if not self.in_budget(): return False
+        self.wakes.append(time.time())
+        self.woken += 1
+        return True
+
+    def should_wake(self, share_now, share, minwatts, sustain=WAKE_SUSTAIN):  # Only for a lasting surplus it can use
+        if self.why_not():
+            self.since, self.wanted = None, False
+            return False
+        if share_now > minwatts: self.wanted = True
+        if share <= minwatts: self.since = None
+        elif self.since is None: self.since = time.monotonic()
+        if self.since is not None and time.monotonic() - self.since >= sustain and self.woke():
+            self.since, self.wanted = None, False
+            return True
+        if self.wanted and share_now <= minwatts and share <= minwatts:
+            self.avoided += 1                               # The surplus came and went without a wake
+            self.wanted = False
+        return False
+
+trackers = {}                                               # Vehicle id -> Tracker
+plans = {}                                                  # Car name -> latest TesCast Plan
+
+def tracker(car):
+    if car['id_s'] not in trackers: trackers[car['id_s']] = Tracker(car)
+    return trackers[car['id_s']]
+
+def load_state():                                           # Blocking, empty if there's no STATE or it won't parse
+    try:
+        with open(STATE) as f: return json.load(f)
+    except (OSError, ValueError): return {}
+
+def save_state(saved):                                      # Blocking, whole file or nothing, and only ours to read
+    with open(STATE + '.tmp', 'w', opener=lambda path, flags: os.open(path, flags, 0o600)) as f: json.dump(saved, f)
+    os.replace(STATE + '.tmp', STATE)
+
+async def KeepState():                                      # Task to write STATE when it changes, now and then if not
+    asyncio.current_task().set_name("KeepState")
+    written, at = None, 0
+
+    def latest():
+        state['cars'] = {known.car['vin']: known.remember() for known in trackers.values()}
+        return dict(state, at=time.time())                  # 'at' shows a restart how much it missed
+
+    def changed():
+        nonlocal written, at
+        saved = latest()
+        now = json.dumps(state, sort_keys=True)
+        if now == written and saved['at'] - at < POLL[2]: return None
+        written, at = now, saved['at']
+        return saved
+
+    await flushing(changed, save_state, POLL[1], pace.sleep, last=latest, failed=unwritten(STATE))   # The latest when TesSense stops
+
+def unwritten(path):                                        # Say why a file can't be written, once an hour at most
+    return lambda e: say(REDTXT + "Can't write " + path + ",", repr(e) + NORMTXT, kind='error', every=3600, key=path, error=repr(e))
 
 def printerror(error,data):                                 # Error message with truncated data
-    print(str(data).split("}")[0],"}\n", datetime.now(TZ).strftime("%a %I:%M %p"), error)
+    say(str(data).split("}")[0],"}\n", STAMP, error, kind='error')
 
-def printmsg(msg):                                          # Timestamped message
-    print(" ", datetime.now(TZ).strftime("%a %I:%M %p"), msg)
+def printmsg(msg, **fields):                                # Timestamped message, and which car with more than one
+    task = asyncio.current_task()
+    who = [task.get_name() + ":"] if task and task.get_name() in fleet else []
+    say(" ", *who, STAMP, msg, **fields)
     
-def print_temp(car, cardata):                               # Car temp and fan status
-    if cardata['climate_state']['inside_temp'] > 35:        # 35°C = 95°F
-        print("+", end='')
+async def print_temp(car, cardata):                         # Car temp and fan status
+    inside, words, command = cardata['climate_state']['inside_temp'], [], None
+    if inside > 35:                                         # 35°C = 95°F
+        words.append("+")
         if not cardata['vehicle_state']['fd_window']:       # Not Open
-            print(GRNBG, "Vent",NORMBG, end=' ')
-            vent(car, 'vent')
+            words, command = words + [GRNBG, "Vent", NORMBG], 'vent'
     else:
         if cardata['vehicle_state']['fd_window']:           # Open
-            print(REDBG, "Close", NORMBG,end=' ')
-            vent(car, 'close')
-    print(car.temp_units(cardata['climate_state']['inside_temp'])+', ', end='')
+            words, command = [REDBG, "Close", NORMBG], 'close'
+    say(*words, car.temp_units(inside), kind='climate', temp=inside, **({'window': command} if command else {}))
+    if command: await vent(car, command)
     #print(cardata['climate_state']['fan_status'],'(fan), ', end='')
     #print(cardata['climate_state']['cabin_overheat_protection_actively_cooling'],'(cop)', end='')
 
 def print_update(chargedata, fast):                         # Display stats at every % change
-    print("\nLevel:",
+    say("\nLevel:",
         chargedata['battery_level'], "%, Limit",
         chargedata['charge_limit_soc'], "%,",
         chargedata['charge_rate'], "MPH",
         chargedata['charger_voltage'], "Volts",
-        chargedata['charge_energy_added'], "kWh added,")
-    if fast: print("Rate:",
+        chargedata['charge_energy_added'], "kWh added,", kind='status', level=chargedata['battery_level'],
+        limit=chargedata['charge_limit_soc'], added_kwh=chargedata['charge_energy_added'])
+    if fast: say("Rate:",
         chargedata['charger_power'], "KWs",
         chargedata['conn_charge_cable'],
         chargedata['fast_charger_type'],
         chargedata['minutes_to_full_charge'], "Minutes remaining\n")
-    else: print(chargedata['charger_actual_current'], "of a possible",
+    else: say(chargedata['charger_actual_current'], "of a possible",
         chargedata['charge_current_request_max'], "Amps,",
-        chargedata['time_to_full_charge'], "Hours remaining\n")
+        chargedata['time_to_full_charge'], "Hours remaining")
+    say("Vehicle data:", cache_stats['fetched'], "fetched,", cache_stats['reused'], "reused from cache")
+    say("Summaries:", summary_stats['fetched'], "fetched,", summary_stats['reused'], "shared")
+    say("Commands:", sum(c.sent for c in commanders.values()), "sent,",
+        sum(c.suppressed for c in commanders.values()), "suppressed")
+    say("Wakes:", sum(t.woken for t in trackers.values()), "performed,",
+        sum(t.avoided for t in trackers.values()), "avoided\n")
         
-def send_cmd(car, cmd, err):                                # Send cmd to Start or Stop charging
-    try: car.command(cmd)
-    except teslapy.VehicleError as e:
-        print(err)
-        printmsg(e)
-
-def set_amps(car, newrate, err):                            # Increase or decrease charging rate
-    try: car.command('CHARGING_AMPS', charging_amps=newrate)
-    except teslapy.VehicleError as e: printerror("V: " + err, e)
-    except teslapy.HTTPError as e: printerror("H: " + err, e)
-
-def set_rate(car, newrate, msg):
-    print(msg, "charging to", newrate, "amps")
-    if newrate == 2: newrate = 1                            # For API a newrate of 3=3, 2=3, 1=2
-    set_amps(car, newrate, "Failed to change")              #  so to set to 2 newrate must be 1
-    if newrate < 5:                                         # if under 5 amps you also need to
-        set_amps(car, newrate, "Failed to change 2")        #  send it twice:
+async def set_rate(car, newrate, rate, msg):                # Increase or decrease charging rate
+    return await commander(car).set_amps(newrate, rate, msg)
         
-def start_charging(car):
-    try:                                                    # Collect new data from Tesla
-        state = car.get_vehicle_data()['charge_state']['charging_state']
-    except teslapy.HTTPError as e:
+async def start_charging(car):                              # True if it's charging afterwards
+    try:                                                    # Latest data from Tesla, cached if recent
+        state = (await vehicle_data(car))['charge_state']['charging_state']
+    except (teslapy.HTTPError, asyncio.TimeoutError) as e:
         printerror("Tesla failed to update, please wait a minute...", e)
-    else:
-        if state != "Charging":
-            print(GRNBG + "Starting" + NORMBG + " charge at 2 Amps")
-            send_cmd(car, 'START_CHARGE', "Won't start charging")
-            set_amps(car, 1, "Won't start charging 2")
-            set_amps(car, 1, "Won't start charging 3")
-
-def stop_charging(car):
-    try:                                                    # Collect new data from Tesla
-        state = car.get_vehicle_data()['charge_state']['charging_state']
-    except teslapy.HTTPError as e:
+        return False
+    if state == "Charging": return True
+    say(GRNBG + "Starting" + NORMBG + " charge at 2 Amps", kind='command', amps=2)
+    if not await commander(car).send('START_CHARGE', "Won't start charging"): return False   # Refused, or over budget
+    await commander(car).send('CHARGING_AMPS', "Won't start charging 2", charging_amps=1)
+    await commander(car).send('CHARGING_AMPS', "Won't start charging 3", charging_amps=1)
+    commander(car).started()
+    return True
+
+async def stop_charging(car):
+    try:                                                    # Latest data from Tesla, cached if recent
+        cardata = await vehicle_data(car)
+    except (teslapy.HTTPError, asyncio.TimeoutError) as e:
         printerror("Unable to get Charging State, please wait a minute...", e)
-    else:
-        if state == "Charging":
-            print(REDBG + "Stopping" + NORMBG + " charge")
-            send_cmd(car, 'STOP_CHARGE', "Failed to stop")
-    try:
-        if car.get_vehicle_data()['vehicle_state']['fd_window']:    # Window's Open
-            vent(car, 'close')
-    except: pass
+        return
+    window = cardata['vehicle_state'].get('fd_window')      # Read before a command invalidates the snapshot
+    if cardata['charge_state']['charging_state'] == "Charging":
+        say(REDBG + "Stopping" + NORMBG + " charge", kind='command', amps=0)
+        await commander(car).send('STOP_CHARGE', "Failed to stop", force=True)
+    if window:                                              # Window's Open
+        await vent(car, 'close')
 
-def vent(car, command):
-    try: car.command('WINDOW_CONTROL', command=command, lat=LAT, lon=LON)
-    except teslapy.VehicleError as e: printmsg("Window_Control Failed " + str(e))
-    else: print(REDTXT + "Windows will now", command + NORMTXT)
+async def vent(car, command):
+    if await commander(car).send('WINDOW_CONTROL', "Window_Control Failed", command=command, lat=LAT, lon=LON):
+        say(REDTXT + "Windows will now", command + NORMTXT)
 
-def wake(car):
+async def wake(car):
     printmsg("Waking...")
-    try: car.sync_wake_up()
-    except teslapy.VehicleError as e:
+    try: await blocking(car.sync_wake_up)
+    except (teslapy.VehicleError, asyncio.TimeoutError) as e:
         printerror("Failed to wake", e)
         return(False)
     else : return(True)
     
+async def LoopLag():                                        # Measure how late the event loop wakes up
+    global loop_lag, loop_lag_max
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(1)
+        loop_lag = loop.time() - start - 1
+        loop_lag_max = max(loop_lag, loop_lag_max)
+        if metrics: metrics.observe('tessense_loop_lag_seconds', max(loop_lag, 0))
+        if loop_lag > LAG_WARN:                             # Something blocked the SenseLink responder
+            printmsg(REDTXT + "Event loop stalled " + str(round(loop_lag, 2)) + " seconds" + NORMTXT, kind='error', lag=loop_lag)
     
-async def sleepnow(min):
-    for x in range(min): await asyncio.sleep(60)
-        
-async def TesSense():
-    await asyncio.sleep(.1)
-    global minwatts, power_diff, timeout, volts, mutable_plug
-    in_service = fullORunplugged = lastemp = level = limit = newrate = rate = 0
+class Scheduler:                                            # When each task polls next, from what it's seen
+    def __init__(self):
+        self.due = {}                                       # Task name -> loop time of its next poll
+        self.nudges = {}                                    # Task name -> Event that polls it early
+        self.failures = {}                                  # Task name -> errors in a row
 
-    retry = teslapy.Retry(total = 3,status_forcelist = (500, 502, 503, 504))
-    with teslapy.Tesla(USERNAME, retry=retry, timeout = 30) as tesla:
-        mycar = tesla.vehicle_list()[0]
+    async def sleep(self, seconds, early=False):            # Till the first aligned poll after seconds, or a nudge if early
+        task, start = asyncio.current_task().get_name(), time.monotonic()   # The event loop's clock too
+        iterated(task)                                      # The sleep isn't part of the pass
+        self.due[task] = due = math.ceil((start + seconds) / POLL_ALIGN) * POLL_ALIGN
+        try:
+            if early: await asyncio.wait_for(self.nudges.setdefault(task, asyncio.Event()).wait(), due - start)
+            else: await asyncio.sleep(due - start)
+        except asyncio.TimeoutError: pass
+        finally:
+            self.nudges.pop(task, None)
+            if metrics: metrics.inc('tessense_sleep_seconds_total', time.monotonic() - start, task=task)
 
-        print("Starting connection to", mycar.get_vehicle_summary()['display_name'], end='')
-        if not mycar.available():
-            print("... []")
-        else:
-            try: cardata=mycar.get_vehicle_data()
-            except: print("Error reading CarData")
+    def nudge(self):                                        # The surplus moved, wake whoever's waiting on it
+        for event in self.nudges.values(): event.set()
+
+    def backoff(self):                                      # Seconds to wait after this task's latest error
+        task = asyncio.current_task().get_name()
+        self.failures[task] = self.failures.get(task, 0) + 1
+        return min(BACKOFF[0] * 2 ** (self.failures[task] - 1), BACKOFF[1])
+
+    def ok(self, task=None): self.failures.pop(task or asyncio.current_task().get_name(), None)
+
+    def charging(self, level, limit, variance, volts):      # Sooner the more the surplus jumps or the nearer the limit
+        seconds = POLL[1] * AMP_HYSTERESIS * volts / (math.sqrt(variance) + 1)
+        if limit - level <= 2: seconds = min(seconds, POLL[1] / 2)  # The car stops itself soon, free that power
+        return min(max(seconds, POLL[0]), POLL[1])
+
+pace = Scheduler()
+        
+async def TesSense(tesla, mycar, name, plug):               # One of these for each car, plug is its SenseLink plug
+    asyncio.current_task().set_name("TesSense" if len(fleet) == 1 else name)
+    planned = None
+    in_service = lastemp = level = limit = newrate = rate = seen = offline = 0
+
+    known = tracker(mycar)
+    if known.seen is not None:                          # Restored from STATE, no need to ask the car
+        say("Starting", mycar['display_name'], "as last seen", datetime.fromtimestamp(known.seen_at, TZ).strftime("%a %I:%M %p"),
+              "at", str(known.level) + "% SoC,", known.why_not() or ("Charging" if known.charging else "Ready"))
+    else:
+        where = "... []"                                # Print whole lines, other cars are starting up too
+        if await online(mycar):                         # One summary fetch covers every car starting up
+            try: cardata = await vehicle_data(mycar)
+            except Exception: where = " Error reading CarData"
             else:
-                print("... [", round(cardata['drive_state']['latitude'], 3), ",", round(cardata['drive_state']['longitude'], 3), "]")
+                where = "... [ " + str(round(cardata['drive_state']['latitude'], 3)) + " , " + str(round(cardata['drive_state']['longitude'], 3)) + " ]"
+        say("Starting connection to", mycar['display_name'] + where)
+        try:                                            # last_seen() fetches vehicle data if none is cached
+            say(" last seen " + await blocking(mycar.last_seen), "at", str(mycar['charge_state']['battery_level']) + "% SoC")
+        except Exception:
+            say(" last seen in the future at some % SoC")
+
+    while True:                                         # Main loop with night time carve out
+        say(GRNBG, CLOCK, NORMBG, "Tesla            \033[A", kind='tick', every=60)
+        if reading.seq <= seen:
+            say("Waiting for UpdateSense()", "\033[A", kind='tick', every=60, key="waiting")
+        iterated(asyncio.current_task().get_name())     # Unless a sleep already ended the last pass
+        sense = await next_reading(seen)                # Sleep until UpdateSense() publishes
+        seen = sense.seq
+        begin(asyncio.current_task().get_name())
+
+        if not sense.fresh():                           # Never act on a failed or stale reading
+            if sense.offline() > 300 and not offline:   # If Sense Times Out for 5 minutes
+                if mycar.get('charge_state', {}).get('charging_state') == "Charging":
+                    offline = True                      # Prevent looping on stop_charging()
+                    await stop_charging(mycar)          # Stop Tesla Charging when Sense offline
+                    if recorder: recorder.car(name, amps=0, target=0, level=known.level)
+            continue
+        offline = False
+        power_diff, volts, minwatts = sense.power_diff, sense.volts, sense.minwatts
+        drawing = loads[name].draw if name in loads else 0
+        share_now = sense.shares_now.get(name, 0) - drawing   # Free power for the car after higher priorities,
+        surplus = int(sense.shares.get(name, 0) - drawing)    #  smoothed is less jumpy when clouds pass
+        max_amps = mycar.get('charge_state', {}).get('charge_current_request_max') or CAR_AMPS
+
         try:
-            print(" last seen " + mycar.last_seen(), "at", str(mycar['charge_state']['battery_level']) + "% SoC")
-        except:
-            print(" last seen in the future at some % SoC")
-
-        while True:                                         # Main loop with night time carve out
-            print(GRNBG, datetime.now(TZ).strftime("%H:%M"), NORMBG, "Tesla            \033[A")
-            
-            if 5 < timeout < 100:                           # If Sense Times Out
-                if mycar['charge_state']['charging_state'] == "Charging":
-                    timeout += 100                              # Prevent looping on stop_charging()
-                    stop_charging(mycar)                        # Stop Tesla Charging when Sense offline
-                    await sleepnow(1)
+            await summaries(tesla)                      # Every car's summary in one call, shared between them
+        except Exception:
+            printmsg("Failed to check In-Service status on Tesla", kind='error')
+        else:
+            in_service = mycar.get('in_service')        # if car is in service mode at Tesla
+            if in_service:
+                printmsg(" Sorry. Currently this car is in Service Mode")
+                await pace.sleep(POLL[2])
+                continue
+                
+        awake = False
+        try: awake = await blocking(mycar.available)    # Only refetches if the summary above failed
+        except Exception:
+            printmsg(REDBG + "Error checking car availability" + NORMBG, kind='error')
+            await pace.sleep(pace.backoff())
+            continue
+        now = datetime.now(TZ)
+        known.saw(awake)
+        plan = profile.plan(time.time(), minwatts, max_amps * volts, max(0, known.limit - known.level) / 100 * BATTERY_KWH,
+                            DEPARTURE) if profile and known.seen else None
+        law = LAW._replace(sleep_until=plan.start, sleep_after=plan.end) if plan and plan.end else LAW
+        night = not daytime(now.hour + now.minute / 60, law)  # The forecast's charging hours, or the fixed ones
+        hours = law._replace(sleep_until=min(law.sleep_until, LAW.sleep_until), sleep_after=max(law.sleep_after, LAW.sleep_after))
+        dark = not daytime(now.hour + now.minute / 60, hours)   # Outside both, a charge now is a top up
+        topup = bool(plan and plan.topup_at and not known.why_not() and (plan.topup_at <= time.time() or dark and known.charging))
+        if plan and (plan.start, plan.end, plan.topup_at is None) != planned:
+            planned = plan.start, plan.end, plan.topup_at is None
+            printmsg("Forecast: charge %02d:%02d to %02d:%02d, %.1f kWh of sun before leaving, %.1f kWh needed%s" %
+                (plan.start, plan.start % 1 * 60, plan.end, plan.end % 1 * 60, plan.solar_kwh, plan.needed_kwh,
+                 "" if plan.topup_at is None else ", grid top up at " + datetime.fromtimestamp(plan.topup_at, TZ).strftime("%H:%M")))
+        if plan: plans[name] = plan
+        reached("first decision")                       # Everything it acts on is known by now
+        steps = (0,) if known.why_not() else amp_steps(max_amps, volts, LAW)
+        later = [POLL[2], (law.sleep_until - now.hour - now.minute / 60) % 24 * 3600]   # Nothing to do till the window
+        if plan and plan.topup_at and plan.topup_at > time.time(): later.append(plan.topup_at - time.time())  #  or a top up
+        rest, wait = max(min(later), POLL[0]), POLL[1]
+        if not awake:                       # Car is sleeping
+            claim(name, 0, steps)
+            if recorder: recorder.car(name, amps=0, target=0, level=known.level)
+            if night and not topup:                     # Not Daytime 8am - 8pm, or as forecast
+                await pace.sleep(rest)
+                continue
+            if known.woke() if topup else known.should_wake(share_now, surplus, minwatts, 0 if plan else WAKE_SUSTAIN):
+                if await wake(mycar):                         # Initial daytime wake() to get status
+                    rate = newrate = 0                  # Reset rate as things will have changed
+                    pace.ok()
+                    continue
+                else:
+                    wait = pace.backoff()
+                    printmsg("Wake error. Sleeping " + str(wait // 60) + " minutes and trying again")
+                    await pace.sleep(wait)              # Give the API a chance to find the car
                     continue
+            else:                                       # The shared summary says when it wakes by itself
+                if known.why_not(): say(known.why_not() + "-", end='')
+                say("Sleeping, free power is", power_diff, "watts", kind='idle', watts=power_diff)
+        else:                                           # Car is awake
+            if not known.charging and not known.stale() and (known.why_not() or not topup and (night or share_now <= minwatts)):
+                claim(name, 0, steps)                   # Nothing to do, leave it alone so it can sleep
+                plug.data_source.power = 0
+                if recorder: recorder.car(name, amps=0, target=0, level=known.level)
+                if known.why_not(): say(known.why_not() + "-", end='')
+                say("Idle, free power is", power_diff, "watts", kind='idle', watts=power_diff)
+                await pace.sleep(rest if night or known.why_not() else POLL[1], early=True)
+                seen = reading.seq
+                continue
+            try:
+                cardata = await vehicle_data(mycar)     # Collect new data from Tesla, or the recent snapshot
+            except (teslapy.HTTPError, asyncio.TimeoutError) as e:
+                printerror("Tesla failed to update, please wait a minute...", e)
+                await pace.sleep(pace.backoff())        # Error: Return to top of order
+                continue
+            else: chargedata = cardata['charge_state']
+            pace.ok()
+
+            home = True
+            if 'latitude' not in cardata['drive_state']:
+                say(REDTXT + "Error: No Location" + NORMTXT)
+            else:                                       # Prevent remote charging issues
+                home = round(cardata['drive_state']['latitude'], 3) == LAT and \
+                       round(cardata['drive_state']['longitude'], 3) == LON
+            known.update(chargedata, home)
 
-            if power_diff == 0 :
-                print("Waiting for UpdateSense()", datetime.now(TZ).strftime("%S"), "\033[A")
-                await asyncio.sleep(1)                      # Syncing with UpdateSense()
+            if chargedata['fast_charger_present']:
+                claim(name, 0, (0,))                     # Not on the house, nothing to share
+                if recorder: recorder.car(name, amps=0, target=0, level=chargedata['battery_level'])
+                printmsg("DC Fast Charging...")
+                print_update(chargedata,1)
+                await pace.sleep(POLL[2])               # Loop while Supercharging back to top
                 continue
 
-            try:
-                in_service = mycar.get_vehicle_summary()['in_service'] # if car is in service mode at Tesla
-            except:
-                printmsg("Failed to check In-Service status on Tesla")
-            else:
-                if in_service:
-                    printmsg(" Sorry. Currently this car is in Service Mode")
-                    await sleepnow(5)
-                    continue
-                    
-            awake = False
-            try: awake = mycar.available()
-            except:
-                printmsg(REDBG + "Error checking car availability" + NORMBG)
-                await sleepnow(5)
+            if not home:                                # Away from home
+                say(round(cardata['drive_state']['latitude'], 3), \
+                     round(cardata['drive_state']['longitude'], 3), end='')
+                printmsg("Away from home. Wait " + str(POLL[2] // 60) + " minutes")
+                claim(name, 0, (0,))
+                if recorder: recorder.car(name, amps=0, target=0, level=chargedata['battery_level'])
+                await pace.sleep(POLL[2])
                 continue
-            if not awake:                       # Car is sleeping
-                if not SLEEP_UNTIL <= datetime.now(TZ).hour < SLEEP_AFTER:  # Not Daytime 8am - 8pm
-                    await sleepnow(2)
-                    continue
-                if power_diff > minwatts and not fullORunplugged:
-                    if wake(mycar):                         # Initial daytime wake() to get status
-                        rate = newrate = 0                  # Reset rate as things will have changed
-                        continue
-                    else:
-                        printmsg("Wake error. Sleeping 10 minutes and trying again")
-                        await sleepnow(10)           # Give the API a chance to find the car
-                        continue
+
+            charging = chargedata['charging_state'] == "Charging"
+            plugged = chargedata['charging_state'] != "Disconnected"
+            if not charging:                            # Draw is 0 whatever was claimed
+                share_now, surplus = sense.shares_now.get(name, 0), int(sense.shares.get(name, 0))
+            action = decide(State(now.hour + now.minute / 60, charging, plugged,
+                chargedata['battery_level'], chargedata['charge_limit_soc'], chargedata['charger_actual_current'],
+                max_amps, share_now, surplus, volts), hours)   # The forecast says when to wake, the sun when to stop
+            claim(name, chargedata['charger_actual_current'] * volts if charging else 0,
+                  amp_steps(max_amps, volts, LAW) if plugged and chargedata['battery_level'] < chargedata['charge_limit_soc'] else (0,))
+
+            if topup and plugged:                       # The sun won't get it to its limit before it leaves
+                rate = chargedata['charger_actual_current'] if charging else 0
+                if not charging:
+                    say(GRNBG + "Topping up" + NORMBG + " from the grid to", chargedata['charge_limit_soc'], "% by",
+                          datetime.fromtimestamp(plan.leave, TZ).strftime("%H:%M"))
+                    if await start_charging(mycar): known.charging = True
+                elif rate < max_amps:
+                    rate = await set_rate(mycar, max_amps, rate, "Topping up,")
+                plug.data_source.power = rate * volts
+                claim(name, rate * volts, (rate * volts,), 0)       # Grid power, not for the plugs to share
+                if recorder: recorder.car(name, amps=rate, target=max_amps, level=chargedata['battery_level'])
+                await pace.sleep(POLL[1])
+                continue
+
+            if action == NIGHT:                                   # Not Daytime 8am - 8pm
+                if charging:
+                    await stop_charging(mycar)
+                    claim(name, 0, loads[name].steps)
+                if recorder: recorder.car(name, amps=0, target=0, level=chargedata['battery_level'])
+                await pace.sleep(rest)
+                continue
+
+            if not charging:                                      # Not charging, check if need to start
+                plug.data_source.power = 0                # Let Sense know we are not charging
+                if recorder: recorder.car(name, amps=0, target=0, level=chargedata['battery_level'])
+                if action == FULL:
+                    say(REDBG + "Full Battery" + NORMBG)
+                    print_update(chargedata,0)
+                elif action == UNPLUGGED:
+                    say(REDTXT + "Please plug in" + NORMTXT + ", power at", power_diff, "watts")
+                elif action == START:                             # Plugged-in and battery is not full
+                    if await start_charging(mycar):
+                        known.charging = True                     # Watch it from now on
+                        plug.data_source.power = 2 * volts    # Let Sense know we ARE charging
+                        claim(name, 2 * volts, loads[name].steps)
                 else:
-                    if fullORunplugged==1: print("Full-", end='')
-                    elif fullORunplugged==2: print("Unplugged-", end='')
-                    print("Sleeping, free power is", power_diff, "watts")
-                    if fullORunplugged:
-                        printmsg(" Wait twenty minutes...")
-                        for x in range(20):
-                            awake = False
-                            await sleepnow(1)
-                            try: awake = mycar.available()
-                            except: printmsg(REDBG + "Failed availability check" + NORMBG)
-                            else:
-                                if awake : break
-                        continue
-            else:                                           # Car is awake
-                try:
-                    cardata = mycar.get_vehicle_data() # Collect new data from Tesla
-                except teslapy.HTTPError as e:
-                    printerror("Tesla failed to update, please wait a minute...", e)
-                    await sleepnow(1)                 # Error: Return to top of order
-                    continue
-                else: chargedata = cardata['charge_state']
+                    say("Not Charging, free power is at",power_diff,"watts", kind='idle', watts=power_diff)
+                    if cardata['vehicle_state']['fd_window']:     # Don't leave windows open
+                        await vent(mycar,'close')
+            else:                                                 # Charging, update status
+                if  level != chargedata['battery_level'] or limit != chargedata['charge_limit_soc']:
+                    level, limit = chargedata['battery_level'], chargedata['charge_limit_soc']
+                    print_update(chargedata, 0)                   # Display charging info every % change
+                    
+                rate = newrate = chargedata['charger_actual_current']
+                wait = pace.charging(chargedata['battery_level'], chargedata['charge_limit_soc'], sense.variance, volts)
+                say("Charging at", rate, "amps, with", surplus, "±", int(math.sqrt(sense.variance)), "watts surplus",
+                    kind='charging', amps=rate, watts=surplus)
 
-                if chargedata['fast_charger_present']:
-                    printmsg("DC Fast Charging...")
-                    print_update(chargedata,1)
-                    await sleepnow(2)                # Loop while Supercharging back to top
-                    continue
+                if action == STOP:                      # Stop charging as there's no free power
+                    await stop_charging(mycar)
+                    newrate = 0
+                elif action.amps > rate:                # Charge faster with any surplus
+                    newrate = await set_rate(mycar, action.amps, rate, "Increasing")
+                elif action.amps:                       # Charge slower due to less availablity
+                    newrate = await set_rate(mycar, action.amps, rate, "Slowing")
+                plug.data_source.power = newrate * volts    # Update Sense with current info (Ha!)
+                claim(name, newrate * volts, loads[name].steps)       # The rest of the surplus is the plugs'
+                if recorder: recorder.car(name, amps=rate if newrate else 0, target=newrate, level=chargedata['battery_level'])
+                if lastemp != cardata['climate_state']['timestamp']:
+                    lastemp = cardata['climate_state']['timestamp']
+                    await print_temp(mycar, cardata)                      # Display cabin temp and fan use
+
+        printmsg("  Wait " + str(round(wait)) + " seconds...", kind='wait', seconds=round(wait))  # After every complete loop
+        await pace.sleep(wait, early=True)              # Sooner if the surplus moves, then Sense needs
+        seen = reading.seq                              #  to see what changed so act on the next reading
+
+
+class PlugIndex:                                            # Alias -> TPLink device, so names aren't looked up every pass
+    def __init__(self, power_manager):
+        self.power_manager, self.devices, self.built = power_manager, {}, None
+        self.failed = -math.inf                             # When listing last failed, it's not tried again for KASA_RETRY
+        self.lock = asyncio.Lock()                          # One rebuild at a time however many polls want it
+
+    def fill(self, devices):
+        self.devices, self.built = {d.get_alias(): d for d in devices}, time.monotonic()
+
+    def stale(self): self.built = None                      # A call failed, rebuild before the next one
+
+    async def get(self, alias):                             # Device, or None if there's no such plug
+        async with self.lock:
+            now = time.monotonic()
+            age = math.inf if self.built is None else now - self.built
+            if (age > KASA_REINDEX or (alias not in self.devices and age > KASA_RETRY)) and now - self.failed > KASA_RETRY:
+                try: self.fill(await list_plugs(self.power_manager))
+                except Exception as e:                      # Keep the plugs we had until the next try
+                    self.failed = now
+                    printerror("Failed to list TPLink devices", e)
+        return self.devices.get(alias)
 
-                if 'latitude' not in cardata['drive_state']:
-                    print(REDTXT + "Error: No Location" + NORMTXT)
-                else:                                       # Prevent remote charging issues
-                    if round(cardata['drive_state']['latitude'], 3) == LAT and \
-                       round(cardata['drive_state']['longitude'], 3) == LON :
-                        if not SLEEP_UNTIL <= datetime.now(TZ).hour < SLEEP_AFTER:
-                            if chargedata['charging_state'] == "Charging":
-                                fullORunplugged = 0
-                                stop_charging(mycar)
-                            await sleepnow(2)
-                            continue
-                    else:                                   # Away from home
-                        print(round(cardata['drive_state']['latitude'], 3), \
-                             round(cardata['drive_state']['longitude'], 3), end='')
-                        printmsg("Away from home. Wait 5 minutes")
-                        fullORunplugged = 2                 # If it's not at home it's unplugged
-                        await sleepnow(5)
-                        continue
-
-                if not chargedata['charging_state'] == "Charging":    # Not charging, check if need to start
-                    mutable_plug.data_source.power = 0                # Let Sense know we are not charging
-                    if power_diff>minwatts and not fullORunplugged:   # Minimum free watts to start charge
-                        if chargedata['battery_level'] >= chargedata['charge_limit_soc']:
-                            print(REDBG + "Full Battery" + NORMBG)
-                            print_update(chargedata,0)
-                            fullORunplugged = 1                       # Set Status to Battery Full
-                        elif chargedata['charging_state'] == "Disconnected":
-                            print(REDTXT + "Please plug in" + NORMTXT + ", power at", power_diff, "watts")
-                            fullORunplugged = 2                       # Set Status to Unplugged
-                        else:                                         # Plugged-in and battery is not full
-                            start_charging(mycar)
-                            mutable_plug.data_source.power = 2 * volts  # Let Sense know we ARE charging
-                    else:
-                        print("Not Charging, free power is at",power_diff,"watts")
-                        if cardata['vehicle_state']['fd_window']:     # Don't leave windows open
-                            vent(mycar,'close')
-                else:                                                 # Charging, update status
-                    if chargedata['battery_level'] < chargedata['charge_limit_soc']:
-                        fullORunplugged = 0                           # Mark it as NOT full and IS plugged-in
-
-                    if  level != chargedata['battery_level'] or limit != chargedata['charge_limit_soc']:
-                        level, limit = chargedata['battery_level'], chargedata['charge_limit_soc']
-                        print_update(chargedata, 0)                   # Display charging info every % change
-                        
-                    rate=chargedata['charger_actual_current']
-                    if volts : newrate = min(rate + int(power_diff / volts), chargedata['charge_current_request_max'])
-                                                           
-                    print("Charging at", rate, "amps, with", power_diff, "watts surplus")
-
-                    if newrate < MINRATE:                   # Stop charging as there's no free power
-                        stop_charging(mycar)
-                        newrate = 0
-                    elif newrate > rate:                    # Charge faster with any surplus
-                        set_rate(mycar, newrate, "Increasing")
-                    elif newrate < rate:                    # Charge slower due to less availablity
-                        set_rate(mycar, newrate, "Slowing")
-                    mutable_plug.data_source.power = newrate * volts    # Update Sense with current info (Ha!)
-                    if lastemp != cardata['climate_state']['timestamp']:
-                        lastemp = cardata['climate_state']['timestamp']
-                        print_temp(mycar, cardata)                      # Display cabin temp and fan use
-
-            printmsg("  Wait two minutes...")               # Message after every complete loop
-            await sleepnow(2)                               # Fastest the Sense API will update is 30 sec.
-
-
-async def CheckTPLink():                                    # Based on github.com/piekstra/tplinkcloud-service
-    def printmsg(msg):                                      # Wrap a balloon around each output from CheckTPLink()
+async def list_plugs(power_manager):                        # Emeter devices, tplinkcloud's listing blocks in requests.post
+    if KASA_BACKEND == 'local': return await timed('get_emeter_devices', power_manager.get_emeter_devices())
+    return await blocking(get_emeter_devices, power_manager)
+
+def get_emeter_devices(power_manager):                      # In a worker thread, its coroutine never really waits
+    return asyncio.run(power_manager.get_emeter_devices())
+
+def sign_in_kasa(tokens):                                   # Blocking, imports the backend, saved token if there is one
+    global tplinkcloud, TesKasa
+    if KASA_BACKEND == 'local':                             # Nothing to sign in to, plugs are found by broadcast
+        TesKasa = importlib.import_module('TesKasa')
+        return TesKasa.LocalDeviceManager(KASA_HOSTS or ())
+    tplinkcloud = importlib.import_module('tplinkcloud')    # Seconds of imports that only a CONTROLLIST needs
+    if not tokens.get('token'):
+        return tplinkcloud.TPLinkDeviceManager(USERNAME, KASAPASS, cache_devices=False, term_id=state['term_id'])
+    device_manager = tplinkcloud.TPLinkDeviceManager(cache_devices=False, term_id=state['term_id'])
+    device_manager.set_auth_token(tokens['token'])          # Refreshed by tplinkcloud itself when it expires
+    device_manager.set_refresh_token(tokens['refresh_token'])
+    return device_manager
+
+def power_tools(device_manager):                            # Emeter devices from whichever backend signed in
+    if KASA_BACKEND == 'local': return TesKasa.LocalPowerTools(device_manager)
+    return tplinkcloud.TPLinkDeviceManagerPowerTools(device_manager)
+
+def keep_kasa(device_manager):                              # Into STATE, tplinkcloud may have refreshed them
+    if KASA_BACKEND == 'local': return
+    state['kasa'] = {'token': device_manager.get_token(), 'refresh_token': device_manager.get_refresh_token()}
+
+async def CheckTPLink(device_manager):                      # Based on github.com/piekstra/tplinkcloud-service
+    def printmsg(msg, kind='plug', **fields):               # Wrap a balloon around each output from CheckTPLink()
 #        if msg.isprintable():
 #        print("=" * (len(max(msg.split('\n'), key=len)) - 13) + datetime.now(TZ).strftime(" %a %I:%M %p"))
-        print("======" + datetime.now(TZ).strftime(" %a %I:%M %p"))
-        print(msg)
-        print("-------------------")
+        say("======", STAMP, "\n" + str(msg) + "\n-------------------", kind=kind, **fields)
 #        print("-" * len(max(msg.split('\n'), key=len)))
 #        else:
-            
-    await asyncio.sleep(1)
-    print("=" * 29 + "\nLooking for TPLink smartplugs\n" + "-" * 29)
-    device_manager = TPLinkDeviceManager(USERNAME, KASAPASS)                # Sign in
-    power_manager = TPLinkDeviceManagerPowerTools(device_manager)           # Get emeter base
-    print("!", end='')
-    devices = await power_manager.get_emeter_devices()                      # Get devices list
-    print("!")
-    if not devices: printmsg("No TPLink (KASA) E-Meter devices found")      # Print Error and Exit
+
+    async def poll(nameddevice):                            # (unit, usage, is off) for one plug, None if unreachable
+        async with kasa_slots:
+            unit = await index.get(nameddevice)
+            if unit is None:
+                printmsg("Cannot find TPLink device " + nameddevice, kind='error', plug=nameddevice)
+                return None
+            if not unit.device_info.status: return None    # Check if unit is online
+            try:
+                usage, off = await asyncio.gather(timed('get_power_usage_realtime', unit.get_power_usage_realtime()),
+                                                  timed('is_off', unit.is_off()))
+            except Exception:
+                printmsg("Cannot find TPLink device status for " + nameddevice, kind='error', plug=nameddevice)
+                index.stale()
+                return None
+            if usage is None or usage.voltage_mv is None:   # Check expected data structure
+                printmsg("Unexpected structure in " + nameddevice, kind='error', plug=nameddevice)
+                return None
+            return unit, usage, off
+
+    async def switch(unit, on):
+        try: await timed('power_on' if on else 'power_off', unit.power_on() if on else unit.power_off())
+        except Exception as e:
+            printerror("Failed to switch " + unit.get_alias(), e)
+            index.stale()
+            return False
+        return True
+
+    asyncio.current_task().set_name("CheckTPLink")
+    say("=" * 29 + "\nLooking for TPLink smartplugs\n" + "-" * 29)
+    power_manager = power_tools(device_manager)                             # Get emeter base
+    say("!", end='')
+    try: devices = await list_plugs(power_manager)          # Get devices list
+    except Exception:                                       # The saved token's been revoked, sign in afresh
+        try:
+            device_manager = await blocking(sign_in_kasa, {})
+            power_manager = power_tools(device_manager)
+            devices = await list_plugs(power_manager)
+        except Exception as e:                              # TP-Link's down, the polls list them when it's back
+            printerror("Failed to list TPLink devices, trying again in " + str(KASA_RETRY) + " seconds", e)
+            devices = None
+    index = PlugIndex(power_manager)
+    if devices is None: index.failed, devices = time.monotonic(), []
+    else: index.fill(devices)
+    say("!")
+    if not devices and not (CONTROLLIST and index.built is None): printmsg("No TPLink (KASA) E-Meter devices found")  # Print Error and Exit
     else:                                                                   # Display devices found
-        print("=" * 29)
+        say("=" * 29)
         if CONTROLLIST:                                                     # Skip list if CL already built
-            print("Found " + str(len(devices)) + " TP-Link E-Meter devices")
-            print("Controlled devices:")
-            for nameddevice in CONTROLLIST:                                 # Controlled Devices Listing
-                device = await power_manager.get_devices_power_usage_realtime(nameddevice)
-                unit = await device_manager.find_device(nameddevice)
-                try: print(nameddevice + " watts = " + str(round(device[0].data.power_mw if device[0].data.power_mw < 1000 else device[0].data.power_mw / 1000)))
-                except: print(nameddevice + " = offline")
+            say("Found " + str(len(devices)) + " TP-Link E-Meter devices")
+            say("Controlled devices:")
+            for nameddevice, polled_plug in zip(CONTROLLIST, await asyncio.gather(*map(poll, CONTROLLIST))):
+                if polled_plug is None: say(nameddevice + " = offline")         # Controlled Devices Listing
+                else: say(nameddevice + " watts = " + str(round(polled_plug[1].power_mw / (1000 if polled_plug[1].voltage_mv > 1000 else 1))))
         else:
-            print("Found " + str(len(devices)) + " TP-Link E-Meter devices:")
+            say("Found " + str(len(devices)) + " TP-Link E-Meter devices:")
             for i, device in enumerate(devices, 1):
-                print('{:25}'.format(device.device_info.alias), end='' if i % 3 else '\n')
-            if i % 3: print()                                               # Trailing CR if not one above
-        print("-" * 29)
+                say('{:25}'.format(device.device_info.alias), end='' if i % 3 else '\n')
+            if i % 3: say()                                               # Trailing CR if not one above
+        say("-" * 29)
 
         overnight = 0
         thishour = datetime.now(TZ).hour
+        seen = 0
+        learned = {}                                        # Plug name -> watts it drew when last seen on
         while True:                                         # Main Loop
-            await sleepnow(1)
-            print(REDBG, datetime.now(TZ).strftime("%H:%M"), NORMBG, "TPLnk            \033[A")
-            if not SLEEP_UNTIL <= datetime.now(TZ).hour < SLEEP_AFTER:   # Sleep Overnight
-                if not overnight: overnight = True; print(BLUTXT+"Sleeping Overnight..."+NORMTXT)
-                await sleepnow(2)
+            iterated("CheckTPLink")
+            keep_kasa(device_manager)
+            seen = (await next_reading(seen)).seq           # Run once per new Sense reading
+            begin("CheckTPLink")
+            say(REDBG, CLOCK, NORMBG, "TPLnk            \033[A", kind='tick', every=60)
+            if not daytime(datetime.now(TZ).hour, LAW):     # Sleep Overnight
+                if not overnight: overnight = True; say(BLUTXT+"Sleeping Overnight..."+NORMTXT)
+                await pace.sleep(POLL[2])
                 continue
-            elif overnight: overnight = False; print(REDTXT+"Good Morning...."+NORMTXT)
+            elif overnight: overnight = False; say(REDTXT+"Good Morning...."+NORMTXT)
                 
             if thishour != (currenthour := datetime.now(TZ).hour):  # Display every hour
                 thishour = currenthour                      # Shows this loop's still going
-                print("=" * 13)                             # Won't correctly show midnight
+                say("=" * 13)                             # Won't correctly show midnight
                 #print(str(thishour - 12 if thishour > 12 else thishour) + " o'clock")
-                print(str(thishour % 12 or 12) + " o'clock")
-                print("-" * 13)                             #  so only run after 8am
-
-            output=[]         # Build output message to display if CONTROLLIST devices are using much power
-            for nameddevice in CONTROLLIST:
-                if timeout > 20:                # if we lost solar info don't keep running
-                    print("Sense timeout - " + REDBG + "Powering off " + NORMBG + nameddevice)
-                    await unit.power_off()
+                say(str(thishour % 12 or 12) + " o'clock")
+                say("-" * 13)                             #  so only run after 8am
+
+            polled = await asyncio.gather(*map(poll, CONTROLLIST))  # Every plug at once, KASA_PARALLEL at a time
+            sense = reading                                 # Latest reading, after the sweep
+            if sense.offline() > 1200:                      # if we lost solar info for 20 minutes don't keep running
+                for nameddevice, polled_plug in zip(CONTROLLIST, polled):
+                    if polled_plug and not polled_plug[2]:
+                        say("Sense timeout - " + REDBG + "Powering off " + NORMBG + nameddevice, kind='plug', plug=nameddevice, on=False)
+                        if await switch(polled_plug[0], False): loads.pop(nameddevice, None)
+                await pace.sleep(POLL[1])
+                continue
+            for nameddevice, polled_plug in zip(CONTROLLIST, polled):   # Tell the allocator what each plug draws
+                if polled_plug is None:
+                    loads.pop(nameddevice, None)            # Can't be switched so don't share anything to it
                     continue
-                    
-                await sleepnow(1)                           # Space out each command
-                try:                                        # Get Unit info from Device Name
-                    unit = await device_manager.find_device(nameddevice)
-                except:
-                    printmsg("Cannot find TPLink device " + nameddevice)
-                    break                                   # Move to the next device
-
-                if unit.device_info.status:                 # Check if unit is online
-                    try:
-                        device = await power_manager.get_devices_power_usage_realtime(nameddevice)
-                    except:
-                        printmsg("Cannot find TPLink device status for " + nameddevice)
-                        continue                            # Move to the next device
-                        
-                    if not hasattr(device[0].data, 'voltage_mv'):           # Check expected data structure
-                        printmsg("Unexpected structure in " + nameddevice)
-                    else:
-                        factor=1000 if device[0].data.voltage_mv > 1000 else 1
-                        watts = device[0].data.power_mw / factor   # If old model plug convert milliwatts to watts
-
-                        if await unit.is_off() and power_diff > 1000 :
-                            printmsg(GRNBG + "Powering on" + NORMBG + ": " + nameddevice)
-                            await unit.power_on()
-                            await sleepnow(1)
-
-                        # Power off nameddevice if it is using more than 5 watts and solar power isn't covering at least half of it's usage
-                        elif watts > 5 and power_diff < -(watts / 2):
-                            printmsg(REDBG + "Powering off" + NORMBG + ": " + nameddevice + "\nBecause " + str(power_diff) + " watts is less than " + str(-(round(watts / 2))) + " watts threshold")
-                            await unit.power_off()
-                            await sleepnow(1)
-
-                        elif watts > 5:                     # Display the stats for each running device
-                            output.append(nameddevice + " = " + str(round(device[0].data.voltage_mv / factor, 2)) + " volts, " + str(round(device[0].data.power_mw/factor,2)) + " watts, " + str(round(device[0].data.current_ma / factor, 2)) + " amps, " + str(round(device[0].data.total_wh / factor, 2)) + " 7-day kWhs")
+                unit, usage, off = polled_plug
+                watts = usage.power_mw / (1000 if usage.voltage_mv > 1000 else 1)  # If old model plug convert milliwatts
+                if not off and watts > 5: learned[nameddevice] = watts             # What it draws when it's on
+                claim(nameddevice, 0 if off else watts, (0, watts if not off else learned.get(nameddevice, KASA_GUESS)), KASA_KEEP)
+                if recorder: recorder.plug(time.time(), nameddevice, watts)
+            if not sense.fresh():                           # Only act on valid Sense data
+                await pace.sleep(POLL[1], early=True)
+                continue
+
+            output = []       # Build output message to display if CONTROLLIST devices are using much power
+            switched = False
+            for nameddevice, polled_plug in zip(CONTROLLIST, polled):
+                if polled_plug is None: continue
+                unit, usage, off = polled_plug
+                factor = 1000 if usage.voltage_mv > 1000 else 1
+                watts, load = usage.power_mw / factor, loads[nameddevice]
+                share = sense.shares.get(nameddevice, 0)    # What the allocator left it after higher priorities
+
+                if off and share:
+                    printmsg(GRNBG + "Powering on" + NORMBG + ": " + nameddevice, plug=nameddevice, on=True)
+                    if await switch(unit, True):
+                        switched = True
+                        claim(nameddevice, share, load.steps, KASA_KEEP)    # Count it before Sense sees it
+
+                # Power off nameddevice if it is using more than 5 watts and solar power isn't covering at least half of it's usage
+                elif not off and watts > 5 and not share:
+                    printmsg(REDBG + "Powering off" + NORMBG + ": " + nameddevice + "\nBecause the surplus left for it is under " + str(round(watts * KASA_KEEP)) + " watts",
+                             plug=nameddevice, on=False, watts=watts)
+                    if await switch(unit, False):
+                        switched = True
+                        claim(nameddevice, 0, (0, watts), KASA_KEEP)
+
+                elif watts > 5:                             # Display the stats for each running device
+                    output.append(nameddevice + " = " + str(round(usage.voltage_mv / factor, 2)) + " volts, " + str(round(usage.power_mw / factor, 2)) + " watts, " + str(round(usage.current_ma / factor, 2)) + " amps, " + str(round(usage.total_wh / factor, 2)) + " 7-day kWhs")
                                                             # total_wh resets weekly to that day's total
-                                                            
-            if output: printmsg(output)
 
+            if output: printmsg(output, kind='plugs')
+            if switched: await pace.sleep(60)               # Give Sense a minute to see the change
+            else: await pace.sleep(POLL[0] if any(load.draw for load in loads.values()) else POLL[1], early=True)
+
+
+def read_stream(sense, loop, sample, stop, done):           # Stream thread: hand each websocket update to the loop
+    updates, error = sense.get_realtime_stream(), ConnectionError("Sense stream ended")
+    try:
+        for data in updates:                                # Only ends by raising when the socket fails
+            if stop.is_set(): break                         #  or here when UpdateSense() is cancelled
+            voltage = data.get('voltage') or [0, 0]
+            loop.call_soon_threadsafe(sample, time.monotonic(), data.get('solar_w', 0), data.get('w', 0), voltage[0] + voltage[1])
+    except Exception as e: error = e
+    finally: updates.close()                                # Closes the websocket
+    try: loop.call_soon_threadsafe(ended, done, error)
+    except RuntimeError: pass                               # The loop's closed, TesSense has stopped
+
+def ended(done, error):
+    if not done.done(): done.set_exception(error)
+
+async def stream(sense, sample):                            # Until the websocket drops, on a thread exit won't wait for
+    loop, stop = asyncio.get_running_loop(), threading.Event()
+    done = loop.create_future()
+    threading.Thread(target=read_stream, args=(sense, loop, sample, stop, done), name="SenseStream", daemon=True).start()
+    try: await done
+    finally: stop.set()                                     # Cancelled, the thread stops at the next update
+
+def sign_in_sense(tokens):                                  # Blocking, with the saved token if there is one
+    sense = Senseable(wss_timeout=30, api_timeout=30, device_id=tokens.get('device_id'))
+    if tokens.get('access_token'):                          # No round trip, the stream says if it's been revoked
+        sense.load_auth(tokens['access_token'], tokens['user_id'], tokens['device_id'], tokens['refresh_token'])
+        sense.set_monitor_id(tokens['monitor_id'])
+    else: sense.authenticate(USERNAME, SENSEPASS)
+    return sense
+
+def keep_sense(sense):                                      # Into STATE, for the next start
+    state['sense'] = {'access_token': sense.sense_access_token, 'user_id': sense.sense_user_id, 'device_id': sense.device_id,
+            'refresh_token': sense.refresh_token, 'monitor_id': sense.sense_monitor_id}
+
+async def UpdateSense(sense):                               # Task to update Sense info via Sense API
+    asyncio.current_task().set_name("UpdateSense")
+    timeout = nudged = 0
+    published = -math.inf                                   # The first sample is published straight away
+    good = time.monotonic()                                 # When Sense last answered
+    smooth = Smoother()
+
+    def sample(stamp, solar, load, volts):                  # Every update from Sense, publish a reading now and then
+        nonlocal timeout, published, nudged, good
+        timeout, good = 0, time.monotonic()                 # Reset to zero when valid data arrives
+        pace.ok("UpdateSense")                              #  and so is the backoff, a drop after it is the first
+        power_diff = solar - load                           # Free power total
+        drawn = sum(each.draw for each in loads.values())   # What TesSense has running, Sense counts it in load
+        smooth.add(power_diff + drawn, stamp)               # Smooth what there is to share out, it won't jump
+        if stamp - published >= PUBLISH_EVERY:              #  when TesSense turns something up or down
+            published = stamp
+            ranked = by_priority()                          # Share it out, car and plugs by CONTROLLIST order
+            publish(power_diff=int(power_diff), volts=int(volts), smoothed=smooth.mean - drawn, variance=smooth.var,
+                    shares=allocate(smooth.mean, ranked), shares_now=allocate(power_diff + drawn, ranked))
+            if recorder: recorder.sample(time.time(), solar, load, volts, smooth.mean - drawn)
+            reached("first reading")
+            if profile: profile.add(time.time(), smooth.mean)
+            if abs(smooth.mean - nudged) > NUDGE * volts:   # Moved enough to be worth acting on now
+                nudged = smooth.mean
+                pace.nudge()
+            say(NORMBG, CLOCK, NORMBG, "Sense            \033[A", kind='tick', every=60)
+
+    def failed():
+        nonlocal timeout
+        timeout += 1                                        # Start or increment timeout count
+        publish(volts=reading.volts, timeout=timeout, down=time.monotonic() - good)  # Invalid info so zero out sum
+        if timeout > 2: printmsg(REDBG + "Sense Timeout #" + str(timeout) + NORMBG, kind='error', timeouts=timeout)
 
-async def UpdateSense():                                    # Task to update Sense info via Sense API
-    print("\033[2J") # ANSI Clearscreen Command
-    global minwatts, power_diff, timeout, volts
-    minwatts = power_diff = timeout = volts = 0
-    print("Initating connection to Sense...")
-    sense=Senseable(wss_timeout=30,api_timeout=30)
-    sense.authenticate(USERNAME, SENSEPASS)
     while True:
         try:
-            #sense.update_trend_data()
-            sense.update_realtime()
-        except:
-            timeout += 1                                # Start or increment timeout count
-            power_diff = 0                              # Each failure causes invalid info so zero out sum
-            if timeout > 2: printmsg(REDBG + "Sense Timeout #" + str(timeout) + NORMBG)
-        else:
-            timeout = 0                                     # Reset to zero when valid data arrives
-            volts = int(sense.active_voltage[0] + sense.active_voltage[1]) # Total voltage between 2 legs
-            power_diff = int(sense.active_solar_power-sense.active_power) # Free power total
-            minwatts = MINRATE * volts                      # Calc minimum watts needed to start charging
-            print(NORMBG, datetime.now(TZ).strftime("%H:%M"), NORMBG, "Sense            \033[A")
-        await sleepnow(1)                             # Fastest the Sense API will update is 30 sec.
+            if SENSE_STREAM:                                # Runs until the websocket drops
+                await stream(sense, sample)
+            else:
+                #sense.update_trend_data()
+                await blocking(sense.update_realtime, timeout=45)
+                sample(time.monotonic(), sense.active_solar_power, sense.active_power,
+                       sense.active_voltage[0] + sense.active_voltage[1])            # Total voltage between 2 legs
+        except SenseAuthenticationException:                # Token expired, update_realtime() renews on its own
+            try: await blocking(sense.renew_auth)
+            except Exception:
+                try: sense = await blocking(sign_in_sense, {})  # The saved token's been revoked, use the password
+                except Exception: failed()
+            keep_sense(sense)
+        except Exception:
+            failed()
+        if timeout: await pace.sleep(pace.backoff())        # Longer after each failure in a row
+        elif not SENSE_STREAM:                              # Fastest the Sense API will update is 30 sec.
+            await pace.sleep(POLL[0] if daytime(datetime.now(TZ).hour, LAW) else POLL[1])
+
+
+def instrument():                                           # What the metrics endpoint serves
+    m = Metrics()
+    m.histogram('tessense_api_seconds', "Seconds each Sense, Tesla and TPLink call took")
+    m.counter('tessense_api_errors_total', "API calls that raised, by exception")
+    m.counter('tessense_api_timeouts_total', "API calls given up on after IO_TIMEOUT")
+    m.histogram('tessense_iteration_seconds', "Seconds each loop's pass took, from a Sense reading till it sleeps", DURATION)
+    m.counter('tessense_sleep_seconds_total', "Seconds each loop spent waiting for its next poll")
+    m.gauge('tessense_next_poll_seconds', "Seconds until each loop polls again, unless nudged",
+        lambda: {(('task', task),): max(due - time.monotonic(), 0) for task, due in pace.due.items()})
+    m.gauge('tessense_startup_seconds', "Seconds each startup step took, and from launch to the first reading and decision",
+        lambda: {(('step', step),): seconds for step, seconds in startup.items()})
+    m.histogram('tessense_loop_lag_seconds', "How late the event loop woke up", LAG)
+    m.gauge('tessense_log_events', "Messages written, dropped with the queue full, held back as repeats, and batches stdout refused",
+        lambda: {(('kind', kind),): count for kind, count in out.counts.items()})
+    m.gauge('tessense_loop_lag_max_seconds', "Worst event loop lag since starting", lambda: loop_lag_max)
+    m.counter('tessense_commands_total', "Tesla commands sent, by command")
+    m.gauge('tessense_commands_last_hour', "Tesla commands sent in the last hour", lambda: sum(
+        t > time.time() - 3600 for c in commanders.values() for t in c.history))
+    m.gauge('tessense_commands_suppressed', "Rate changes held back or over budget",
+        lambda: sum(c.suppressed for c in commanders.values()))
+    m.gauge('tessense_vehicle_data', "Vehicle data fetched and reused from cache",
+        lambda: {(('source', k),): v for k, v in cache_stats.items()})
+    m.gauge('tessense_vehicle_summaries', "Every car's summary fetched, and shared by cars asking within CACHE_TTL",
+        lambda: {(('source', k),): v for k, v in summary_stats.items()})
+    m.gauge('tessense_forecast_kwh', "Solar each car should get before it leaves, and what it needs",
+        lambda: {key: value for car, plan in plans.items() for key, value in
+                 (((('car', car), ('kind', 'solar')), plan.solar_kwh), ((('car', car), ('kind', 'needed')), plan.needed_kwh))})
+    m.gauge('tessense_wakes', "Cars woken, and surplus that came and went without waking them",
+        lambda: {(('kind', 'performed'),): sum(t.woken for t in trackers.values()),
+                 (('kind', 'avoided'),): sum(t.avoided for t in trackers.values())})
+    m.gauge('tessense_surplus_watts', "Latest free power from Sense, raw and smoothed",
+        lambda: {(('kind', 'raw'),): reading.power_diff, (('kind', 'smoothed'),): reading.smoothed})
+    m.gauge('tessense_sense_age_seconds', "Seconds since the latest Sense reading", lambda: time.monotonic() - reading.stamp)
+    return m
 
+async def serve_metrics():                                  # Task for the endpoint, charging goes on without it
+    try: await metrics.serve(METRICS_HOST, METRICS_PORT)
+    except OSError as e: say(REDTXT + "No metrics endpoint on " + METRICS_HOST + ":" + str(METRICS_PORT) + ",", str(e) + NORMTXT,
+                             kind='error', error=str(e))
 
 async def main():                                           # Much thanks to cbpowell for this SenseLink code:
     # Create controller, with NO config
-    global mutable_plug
+    global recorder, metrics, profile, state, launched, out, io_slots, kasa_slots, summary_lock, new_reading
+    launched = time.monotonic()
+    io_slots, kasa_slots = asyncio.Semaphore(IO_WORKERS), asyncio.Semaphore(KASA_PARALLEL)
+    summary_lock, new_reading = asyncio.Lock(), asyncio.Event()
+    asyncio.current_task().set_name("main")
+    out = Output(LOG_FORMAT, TZ, time)
+    writer = asyncio.ensure_future(out.run())               # Writing from the start, the sign ins take a while
     controller = SenseLink(None)
-    
-    # Create a PlugInstance, setting at least the name for Sense and MAC
-    mutable_plug = PlugInstance("mutable", alias="Tesla", mac="53:75:31:f8:3a:8c")
-    # Create and assign a Mutable Data Source to that plug
-    mutable_data_source = MutableSource("mutable", None)
-    mutable_plug.data_source = mutable_data_source
-    
-    # Add that plug to the controller
-    controller.add_instances({mutable_plug.identifier:mutable_plug})
+    say("\033[2J", kind='screen') # ANSI Clearscreen Command
+    say("Signing in to Sense, Tesla" + (" and TPLink..." if CONTROLLIST else "..."))
+    if STATE: state = await phase("state", blocking(load_state))
+    age = time.time() - state.pop('at', 0)                  # Negative when the clock's behind, no RTC and no NTP yet
+    fresh = 0 <= age < POLL[2] + DOZE                       # Saved recently enough that nothing was missed
+    state.setdefault('term_id', str(uuid.uuid4()))          # TPLink ties its tokens to this
+
+    retry = teslapy.Retry(total = 3,status_forcelist = (500, 502, 503, 504))
+    tesla = teslapy.Tesla(USERNAME, retry=retry, timeout = 30)
+    sense, cars, device_manager, profile = await asyncio.gather(   # Each waits on its own servers, so all at once
+        phase("Sense", blocking(sign_in_sense, state.get('sense', {}))),
+        phase("Tesla", blocking(tesla.vehicle_list, timeout=None)),   # A first login waits on input(), however long
+        phase("TPLink", blocking(sign_in_kasa, state.get('kasa', {}))) if CONTROLLIST else asyncio.sleep(0),
+        phase("forecast", blocking(Profile.open, FORECAST, TZ, RECORD)) if FORECAST else asyncio.sleep(0))
+    keep_sense(sense)
+    cars = [car for car in cars                             # Every car on the account, or those in VEHICLES
+            if not VEHICLES or car['display_name'] in VEHICLES or car['vin'] in VEHICLES]
+    if VEHICLES: cars.sort(key=lambda car: VEHICLES.index(car['display_name'] if car['display_name'] in VEHICLES else car['vin']))
+    if not cars: say(REDTXT + "No vehicles found to charge" + NORMTXT)
+    for car in cars: tracker(car).restore(state.get('cars', {}).get(car['vin'], {}), fresh)
 
     # Get SenseLink tasks to add these
     tasks = controller.tasks
-    tasks.add(UpdateSense())                                     # Spawn the UpdateSense() function as a coroutine
-    tasks.add(TesSense())                                     # Spawn the TesSense() function as another coroutine
-    if CONTROLLIST: tasks.add(CheckTPLink())                      # Spawn the CheckTPLink() function also, if needed
+    tasks.add(UpdateSense(sense))                                # Spawn the UpdateSense() function as a coroutine
+    for n, car in enumerate(cars):
+        name = car['display_name'] or car['vin'] if len(cars) > 1 else "Tesla"
+        if name in fleet or name in (CONTROLLIST or ()):  # Loads are shared by name, so two can't have the same one
+            name += " " + car['vin'][-6:]
+            say(REDTXT + "Another car or plug has its name, calling it", name + NORMTXT)
+        fleet[name] = car
+        # Create a PlugInstance, setting at least the name for Sense and MAC, the first car keeps the original
+        mac = "53:75:31:f8:3a:8c" if n == 0 else "53:75:" + ":".join("%02x" % b for b in hashlib.sha1(car['vin'].encode()).digest()[:4])
+        identifier = "mutable" if n == 0 else "mutable-" + car['vin']
+        plug = PlugInstance(identifier, alias=name, mac=mac)
+        # Create and assign a Mutable Data Source to that plug
+        plug.data_source = MutableSource(identifier, None)
+        # Add that plug to the controller
+        controller.add_instances({plug.identifier:plug})
+        tasks.add(TesSense(tesla, car, name, plug))                 # Spawn a TesSense() for each car as another coroutine
+    if CONTROLLIST: tasks.add(CheckTPLink(device_manager))        # Spawn the CheckTPLink() function also, if needed
+    tasks.add(LoopLag())                                        # Watch for anything stalling the SenseLink replies
+    tasks.add(writer)                                           # Everything said, written off the event loop
+    if RECORD:
+        recorder = Recorder(RECORD)
+        tasks.add(recorder.run(failed=unwritten(RECORD)))       # Flush history to disk in batches
+    if FORECAST: tasks.add(profile.run(FORECAST, failed=unwritten(FORECAST)))   # Save what it learns now and then
+    if STATE: tasks.add(KeepState())                            # Tokens and cars' state for the next start
+    if METRICS_PORT:
+        metrics = instrument()
+        tasks.add(serve_metrics())                              # Prometheus scrapes, beside SenseLink's server
     tasks.add(controller.server_start())
 
     logging.info("Starting controller.tasks")
-    await asyncio.gather(*tasks)
+    with tesla:                                                 # One Tesla session shared by every car
+        await asyncio.gather(*tasks)
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,437 @@
+"""
+ TesSim - Offline simulator for TesSense
+ Stands in for Sense, Tesla, SenseLink and TPLink with local fakes driven by a
+ solar and house load trace, and runs TesSense's own tasks on a virtual clock
+ so a whole day replays in seconds instead of waiting for the sun.
+
+    python3 TesSim.py                          A synthetic sunny day
+    python3 TesSim.py --clouds .6 --days 3     Partly cloudy, three days
+    python3 TesSim.py --trace day.csv          Recorded trace: epoch seconds, solar watts, load watts
+    python3 TesSim.py --plugs Heater:1500,TV:150 --verbose
+    python3 TesSim.py --cars 2 --soc 60,30      Two cars sharing the surplus
+    python3 TesSim.py --drop 600               Sense's websocket dropping every 10 minutes
+"""
+
+import argparse, asyncio, bisect, concurrent.futures, contextlib, csv, math, os, random, selectors, sys, threading, time, types
+from datetime import datetime, timedelta
+
+STEP = 10                                                   # Seconds between energy accounting updates
+SLEEP_IDLE = 15 * 60                                        # Seconds before an idle car falls asleep
+WAKE_SECONDS = 20                                           # How long sync_wake_up() takes
+DRIVE_SECONDS = 1800                                        # How long a --drive keeps the car in use
+KASA_LATENCY = .3                                           # Seconds for each TPLink cloud call
+STREAM_EVERY = 2                                            # Seconds between updates on Sense's websocket
+BATTERY_KWH = 75                                            # Usable battery size
+VOLTS = 240
+
+
+class Clock:                                                # Virtual time, only moves when every task is waiting
+    def __init__(self, start): self.start, self.elapsed = start, 0.0
+    now = property(lambda self: self.start + self.elapsed)
+    def time(self): return self.now
+    def monotonic(self): return self.elapsed                # Small numbers keep the loop's timers exact
+    def sleep(self, seconds): self.elapsed += seconds       # For blocking calls in the fakes
+
+class SimSelector(selectors.DefaultSelector):               # Jump the clock ahead instead of waiting
+    def __init__(self, clock):
+        super().__init__()
+        self.clock = clock
+
+    def select(self, timeout=None):
+        ready = super().select(0)
+        if not ready and timeout: self.clock.elapsed += timeout
+        return ready
+
+class SimLoop(asyncio.SelectorEventLoop):
+    def __init__(self, clock):
+        super().__init__(SimSelector(clock))
+        self.clock = clock
+    def time(self): return self.clock.elapsed
+
+class InlineExecutor(concurrent.futures.Executor):          # Worker threads would race the virtual clock
+    def __init__(self): self.worker = concurrent.futures.ThreadPoolExecutor(1)  # Off the loop's thread, waited for
+
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        try: future.set_result(self.worker.submit(fn, *args, **kwargs).result())
+        except BaseException as e: future.set_exception(e)
+        return future
+
+
+class Trace:                                                # Solar and house load in watts over time
+    def __init__(self, rows):
+        self.rows = sorted(rows)
+        self.times = [row[0] for row in self.rows]
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls([(float(t), float(solar), float(load)) for t, solar, load, *_ in csv.reader(f) if t[0].isdigit()])
+
+    @classmethod
+    def synthetic(cls, start, days, tz, peak=7000, clouds=0.0, base=450, seed=1):
+        rand, rows, shade = random.Random(seed), [], 1.0
+        for t in range(int(start), int(start + days * 86400), 60):
+            local = datetime.fromtimestamp(t, tz)
+            hour = local.hour + local.minute / 60
+            sun = max(0.0, math.sin(math.pi * (hour - 6) / 14)) ** 1.5 * peak   # 6am to 8pm
+            if rand.random() < clouds / 10: shade = rand.uniform(.15, .6)       # A cloud arrives
+            elif rand.random() < .15: shade = 1.0                               #  or moves on
+            load = base + (rand.random() < .05) * rand.choice((1200, 1800, 600))
+            rows.append((t, int(sun * shade), load))
+        return cls(rows)
+
+    def at(self, t):                                        # Values of the last row at or before t
+        return self.rows[max(bisect.bisect_right(self.times, t) - 1, 0)][1:]
+
+
+class World:                                                # Everything the fakes share, with the energy accounting
+    def __init__(self, clock, socs, limits, plugs, cars=1):
+        self.clock, self.trace, self.lat, self.lon = clock, None, 0, 0
+        self.loop, self.drop = None, 0                      # Sense's stream keeps in step with the loop, drops this often
+        self.cars = [{'id': str(n), 'vin': '5YJ3E1EA0SIM%05d' % n, 'name': 'SimCar %d' % n,
+                      'soc': socs[(n - 1) % len(socs)], 'limit': limits[(n - 1) % len(limits)], 'amps': 0, 'max': 32,
+                      'state': 'Stopped', 'plugged': True, 'awake': True, 'active': clock.now, 'window': 0, 'added': 0.0}
+                     for n in range(1, cars + 1)]
+        self.plugs = {name: {'watts': watts, 'on': False} for name, watts in plugs.items()}
+        self.commands, self.wakes, self.fetches, self.summaries = {}, 0, 0, 0
+        self.drive, self.leave = 0, None                    # SoC % each car uses a day, and when it next leaves
+        self.kwh = {'car_solar': 0.0, 'car_grid': 0.0, 'plug_solar': 0.0, 'plug_grid': 0.0, 'exported': 0.0, 'solar': 0.0}
+
+    def car_watts(self, car=None):                          # One car's draw, or all of them
+        if car is None: return sum(self.car_watts(car) for car in self.cars)
+        return car['amps'] * VOLTS if car['state'] == "Charging" else 0
+    def plug_watts(self): return sum(p['watts'] for p in self.plugs.values() if p['on'])
+
+    def asleep(self, car):                                  # An idle car falls asleep, a charging one stays up
+        if car['awake'] and car['state'] != "Charging" and self.clock.now - car['active'] > SLEEP_IDLE:
+            car['awake'] = False
+        return not car['awake']
+
+    async def run(self):                                    # Charge the battery and account for where energy went
+        while True:
+            await asyncio.sleep(STEP)
+            solar, load = self.trace.at(self.clock.now)
+            car, plugs = self.car_watts(), self.plug_watts()
+            free = max(0, solar - load)                     # The house always comes first
+            plug_solar = min(plugs, free)
+            car_solar = min(car, free - plug_solar)
+            hours = STEP / 3600
+            for key, watts in (('car_solar', car_solar), ('car_grid', car - car_solar), ('plug_solar', plug_solar),
+                               ('plug_grid', plugs - plug_solar), ('exported', free - plug_solar - car_solar), ('solar', solar)):
+                self.kwh[key] += watts * hours / 1000
+            if self.leave and self.clock.now >= self.leave:  # Out and back while nobody's watching
+                self.leave += 86400
+                for each in self.cars:
+                    each.setdefault('left', []).append(each['soc'])
+                    each.update(soc=max(0, each['soc'] - self.drive), state="Stopped", amps=0, awake=True,
+                                active=self.clock.now + DRIVE_SECONDS)
+            for each in self.cars:
+                if watts := self.car_watts(each):
+                    each['added'] += watts * hours / 1000
+                    each['soc'] += watts * hours / 1000 / BATTERY_KWH * 100
+                    each['active'] = self.clock.now
+                    if each['soc'] >= each['limit']:
+                        each['state'], each['amps'] = "Complete", 0
+
+
+def fake_sense(world):                                      # sense_energy stand in
+    module = types.ModuleType('sense_energy')
+    class SenseAuthenticationException(Exception): pass
+
+    class Senseable:
+        def __init__(self, *args, device_id=None, **kwargs):
+            self._realtime, self.device_id = {}, device_id or 'sim'
+            self.sense_access_token = self.sense_user_id = self.refresh_token = self.sense_monitor_id = None
+        def authenticate(self, username, password):
+            self.sense_access_token, self.sense_user_id, self.refresh_token, self.sense_monitor_id = 'token', 1, 'refresh', 1
+        def load_auth(self, access_token, user_id, device_id, refresh_token):
+            self.sense_access_token, self.sense_user_id, self.device_id, self.refresh_token = access_token, user_id, device_id, refresh_token
+        def set_monitor_id(self, monitor_id): self.sense_monitor_id = monitor_id
+        def renew_auth(self): pass
+        def update_realtime(self):
+            solar, load = world.trace.at(world.clock.now)
+            self._realtime = {'solar_w': solar, 'w': load + world.car_watts() + world.plug_watts(),
+                              'voltage': [VOLTS / 2, VOLTS / 2]}
+        def get_realtime_stream(self):                      # On TesSense's stream thread, paced by the virtual clock
+            loop, thread, opened, posted = world.loop, threading.current_thread(), world.clock.now, None
+            while True:
+                due, taken = threading.Event(), threading.Event()
+                at = (math.floor(loop.time() / STREAM_EVERY + 1e-6) + 1) * STREAM_EVERY
+                loop.call_soon_threadsafe(loop.call_at, at, update, due, taken, thread)
+                if posted: posted.set()                     # The last update's with the loop and the next is booked
+                due.wait()
+                posted = taken
+                if world.drop and world.clock.now - opened >= world.drop: raise ConnectionError("websocket dropped")
+                self.update_realtime()
+                yield self._realtime
+        active_power = property(lambda self: self._realtime.get('w', 0))
+        active_solar_power = property(lambda self: self._realtime.get('solar_w', 0))
+        active_voltage = property(lambda self: self._realtime.get('voltage', []))
+
+    def update(due, taken, thread):                         # On the loop, the clock holds till the stream has posted it
+        due.set()
+        while not taken.wait(.01) and thread.is_alive(): pass
+
+    module.Senseable, module.SenseAuthenticationException = Senseable, SenseAuthenticationException
+    return module
+
+def fake_teslapy(world):                                    # teslapy stand in, a car for each of world.cars
+    module = types.ModuleType('teslapy')
+    class VehicleError(Exception): pass
+    class HTTPError(Exception): pass
+    class Retry:
+        def __init__(self, **kwargs): pass
+
+    def summary(car):                                       # What VEHICLE_SUMMARY and PRODUCT_LIST say about a car
+        return {'id_s': car['id'], 'vehicle_id': int(car['id']), 'vin': car['vin'], 'display_name': car['name'],
+                'in_service': False, 'state': 'asleep' if world.asleep(car) else 'online'}
+
+    class Vehicle(dict):
+        def __init__(self, car, tesla):
+            super().__init__(summary(car))
+            self.car, self.tesla, self.timestamp = car, tesla, world.clock.now
+
+        def get_vehicle_summary(self):
+            world.summaries += 1
+            self.update(summary(self.car))
+            self.timestamp = world.clock.now
+            return self
+
+        def available(self, max_age=60):                    # Cached state, which may be out of date
+            if self.timestamp + max_age < world.clock.now: self.get_vehicle_summary()
+            return self['state'] == 'online'
+        def last_seen(self): return 'just now'
+        def temp_units(self, celcius): return '%.1f F' % (celcius * 1.8 + 32)
+
+        def sync_wake_up(self, timeout=60, interval=2, backoff=1.15):
+            if world.asleep(self.car):
+                world.clock.sleep(WAKE_SECONDS)
+                world.wakes += 1
+                self.car.update(awake=True, active=world.clock.now)
+            self.update(state='online')
+            self.timestamp = world.clock.now
+
+        def get_vehicle_data(self):
+            if world.asleep(self.car): raise HTTPError("408 Client Error: vehicle unavailable")
+            world.fetches += 1
+            car, stamp = self.car, int(world.clock.now * 1000)
+            self.timestamp = world.clock.now
+            car['active'] = world.clock.now
+            self.update(state='online', drive_state={'latitude': world.lat, 'longitude': world.lon, 'timestamp': stamp},
+                climate_state={'inside_temp': 25, 'timestamp': stamp}, vehicle_state={'fd_window': car['window']},
+                charge_state={'battery_level': int(car['soc']), 'charge_limit_soc': car['limit'],
+                    'charging_state': car['state'] if car['plugged'] else "Disconnected",
+                    'charger_actual_current': world.car_watts(car) // VOLTS, 'charge_current_request': car['amps'],
+                    'charge_current_request_max': car['max'], 'charger_voltage': VOLTS, 'charger_power': world.car_watts(car) // 1000,
+                    'charge_rate': 0, 'charge_energy_added': round(car['added'], 2), 'fast_charger_present': False,
+                    'fast_charger_type': '', 'conn_charge_cable': 'SAE', 'minutes_to_full_charge': 0,
+                    'time_to_full_charge': 0, 'timestamp': stamp})
+            return self
+
+        def command(self, name, **kwargs):
+            if world.asleep(self.car): raise HTTPError("408 Client Error: vehicle unavailable")
+            world.commands[name] = world.commands.get(name, 0) + 1
+            car = self.car
+            car['active'] = world.clock.now
+            if name == 'START_CHARGE':
+                if not car['plugged'] or car['soc'] >= car['limit']: raise VehicleError('not_charging')
+                car['state'], car['amps'] = "Charging", car['amps'] or 5
+            elif name == 'STOP_CHARGE':
+                if car['state'] != "Charging": raise VehicleError('not_charging')
+                car['state'], car['amps'] = "Stopped", 0
+            elif name == 'CHARGING_AMPS':                   # For API a newrate of 3=3, 2=3, 1=2
+                amps = kwargs['charging_amps']
+                car['amps'] = min(amps + 1 if amps < 3 else amps, car['max'])
+            elif name == 'WINDOW_CONTROL':
+                car['window'] = int(kwargs['command'] == 'vent')
+            return True
+
+    class Tesla:
+        def __init__(self, email, **kwargs): self.cars = [Vehicle(car, self) for car in world.cars]
+        def __enter__(self): return self
+        def __exit__(self, *exc): pass
+        def vehicle_list(self): return self.cars
+        def api(self, name, path_vars=None, **kwargs):
+            if name != 'PRODUCT_LIST': raise NotImplementedError(name)
+            world.summaries += 1
+            return {'response': [summary(car) for car in world.cars]}
+
+    for item in (VehicleError, HTTPError, Retry, Vehicle, Tesla): setattr(module, item.__name__, item)
+    return module
+
+def fake_senselink():                                       # senselink stand in, nothing listens on the network
+    module, plug_instance, data_source = (types.ModuleType(name) for name in
+        ('senselink', 'senselink.plug_instance', 'senselink.data_source'))
+    class SenseLink:
+        def __init__(self, config=None, port=9999): self.tasks, self.instances = set(), {}
+        def add_instances(self, instances): self.instances.update(instances)
+        async def server_start(self): await asyncio.Event().wait()
+    class PlugInstance:
+        def __init__(self, identifier, alias=None, mac=None, device_id=None):
+            self.identifier, self.alias, self.mac, self.data_source = identifier, alias, mac, None
+    class MutableSource:
+        def __init__(self, identifier, details, controller=None): self.identifier, self.power = identifier, 0.0
+    module.SenseLink, plug_instance.PlugInstance, data_source.MutableSource = SenseLink, PlugInstance, MutableSource
+    return module, plug_instance, data_source
+
+def fake_tplinkcloud(world):                                # tplinkcloud stand in, every plug has an emeter
+    module = types.ModuleType('tplinkcloud')
+
+    class Plug:
+        def __init__(self, name):
+            self.name, self.device_id, self.child_id = name, name, None
+            self.device_info = types.SimpleNamespace(alias=name, status=1)
+        def get_alias(self): return self.name
+        def has_emeter(self): return True
+        async def is_on(self):
+            await asyncio.sleep(KASA_LATENCY)
+            return world.plugs[self.name]['on']
+        async def is_off(self): return not await self.is_on()
+        async def power_on(self): await self.switch(True)
+        async def power_off(self): await self.switch(False)
+        async def switch(self, on):
+            await asyncio.sleep(KASA_LATENCY)
+            world.plugs[self.name]['on'] = on
+        async def get_power_usage_realtime(self):
+            await asyncio.sleep(KASA_LATENCY)
+            watts = world.plugs[self.name]['watts'] if world.plugs[self.name]['on'] else 0
+            return types.SimpleNamespace(power_mw=watts * 1000, voltage_mv=VOLTS / 2 * 1000,
+                                         current_ma=watts / VOLTS * 2000, total_wh=0)
+
+    class TPLinkDeviceManager:
+        def __init__(self, username=None, password=None, **kwargs):
+            self.devices = [Plug(name) for name in world.plugs]
+            self.token, self.refresh = ('token', 'refresh') if username else (None, None)
+        def set_auth_token(self, token): self.token = token
+        def set_refresh_token(self, token): self.refresh = token
+        def get_token(self): return self.token
+        def get_refresh_token(self): return self.refresh
+        async def get_devices(self):                        # Blocking in tplinkcloud, so it takes no sim time
+            return self.devices
+        async def find_device(self, name):
+            return next((d for d in await self.get_devices() if d.get_alias() == name), None)
+        async def find_devices(self, like):
+            return [d for d in await self.get_devices() if like.lower() in d.get_alias().lower()]
+
+    class TPLinkDeviceManagerPowerTools:
+        def __init__(self, device_manager): self.device_manager = device_manager
+        async def get_emeter_devices(self, devices_like=None):
+            if devices_like: return await self.device_manager.find_devices(devices_like)
+            return await self.device_manager.get_devices()
+        async def get_devices_power_usage_realtime(self, devices_like):
+            return [types.SimpleNamespace(device_id=d.device_id, name=d.name, data=await d.get_power_usage_realtime())
+                    for d in await self.get_emeter_devices(devices_like)]
+
+    module.TPLinkDeviceManager, module.TPLinkDeviceManagerPowerTools = TPLinkDeviceManager, TPLinkDeviceManagerPowerTools
+    return module
+
+
+def install(world):                                         # Make TesSense import the fakes
+    sys.modules['sense_energy'] = fake_sense(world)
+    sys.modules['teslapy'] = fake_teslapy(world)
+    sys.modules['senselink'], sys.modules['senselink.plug_instance'], sys.modules['senselink.data_source'] = fake_senselink()
+    sys.modules['tplinkcloud'] = fake_tplinkcloud(world)
+
+def simulate(args):
+    clock = Clock(0)
+    plugs = dict((name, int(watts)) for name, watts in (p.split(':') for p in args.plugs.split(','))) if args.plugs else {}
+    world = World(clock, args.soc, args.limit, plugs, args.cars)
+    install(world)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import TesSense                                         # Must come after install()
+
+    clock.start = datetime.strptime(args.date, "%Y-%m-%d").replace(tzinfo=TesSense.TZ).timestamp()
+    for car in world.cars: car['active'] = clock.start
+    world.lat, world.lon = TesSense.LAT, TesSense.LON
+    world.trace = Trace.load(args.trace) if args.trace else \
+        Trace.synthetic(clock.now, args.days, TesSense.TZ, args.peak, args.clouds, seed=args.seed)
+
+    class SimDatetime(datetime):                            # datetime.now() on the virtual clock
+        @classmethod
+        def now(cls, tz=None): return datetime.fromtimestamp(clock.now, tz)
+
+    TesSense.io_pool, TesSense.time, TesSense.datetime = InlineExecutor(), clock, SimDatetime
+    TesSense.SENSE_STREAM, TesSense.CONTROLLIST = not args.poll, list(plugs) or 0
+    world.drop = args.drop
+    TesSense.SPLIT = args.split or TesSense.SPLIT
+    TesSense.RECORD = args.record                           # Off unless asked, never the live tessense.db
+    TesSense.FORECAST = args.forecast                       # Off unless asked, never the live tessense.json
+    TesSense.STATE = args.state                             # Off unless asked, never the live tokens
+    TesSense.LOG_FORMAT = args.log
+    fake_plugs = None
+    if args.kasa == 'local':                                # TesKasa's fake plugs on loopback instead of a fake cloud
+        import TesKasa
+        TesSense.KASA_BACKEND, TesKasa.BROADCAST = 'local', '127.0.0.1'
+        fake_plugs = TesKasa.FakePlugs(world.plugs, volts=VOLTS / 2)
+    if args.drive: world.drive, world.leave = args.drive, clock.start + TesSense.DEPARTURE * 3600
+    TesSense.METRICS_PORT = 0                               # No endpoint, but --metrics still collects
+    TesSense.metrics = TesSense.instrument() if args.metrics else None
+
+    async def run():
+        if fake_plugs: await fake_plugs.start()
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(asyncio.gather(TesSense.main(), world.run()), args.days * 86400)
+        if fake_plugs:
+            fake_plugs.close()
+            await asyncio.sleep(1)                          # Let the connections see they're closed
+
+    began = time.perf_counter()
+    loop = world.loop = SimLoop(clock)
+    output = sys.stdout if args.verbose else open(os.devnull, 'w')
+    try:
+        with contextlib.redirect_stdout(output):
+            loop.run_until_complete(run())
+    finally:
+        loop.close()
+        if output is not sys.stdout: output.close()
+    report(world, TesSense, args.days, time.perf_counter() - began)
+    if fake_plugs: print("Kasa plugs answered %d requests over %d connections" % (fake_plugs.requests, fake_plugs.connections))
+    if TesSense.metrics: print(TesSense.metrics.render(), end='')
+    return world
+
+def report(world, TesSense, days, seconds):
+    kwh = world.kwh
+    commanders = TesSense.commanders.values()
+    print("Simulated", days, "day(s) in", round(seconds, 1), "seconds")
+    print("Commands:", sum(world.commands.values()), world.commands or '',
+          "suppressed", sum(c.suppressed for c in commanders))
+    print("Wakes:", world.wakes, "(", sum(t.avoided for t in TesSense.trackers.values()), "avoided )",
+          " Vehicle data fetches:", world.fetches, "(", TesSense.cache_stats['reused'], "reused from cache )",
+          " Summaries:", world.summaries, "(", TesSense.summary_stats['reused'], "shared )")
+    print("Cars charged %.1f kWh, %.1f from surplus and %.1f from grid" %
+          (kwh['car_solar'] + kwh['car_grid'], kwh['car_solar'], kwh['car_grid']))
+    for car in world.cars:
+        print("  %s charged %.1f kWh, now at %d%% SoC" % (car['name'], car['added'], car['soc']),
+              "" if 'left' not in car else "left at " + ", ".join("%d%%" % soc for soc in car['left']))
+    if world.plugs:
+        print("Plugs used %.1f kWh, %.1f from surplus and %.1f from grid" %
+              (kwh['plug_solar'] + kwh['plug_grid'], kwh['plug_solar'], kwh['plug_grid']))
+    print("Solar made %.1f kWh, %.1f exported" % (kwh['solar'], kwh['exported']))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a day of solar through TesSense offline")
+    parser.add_argument('--trace', help="CSV of epoch seconds, solar watts, load watts")
+    parser.add_argument('--date', default=(datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d"), help="First day, YYYY-MM-DD")
+    parser.add_argument('--days', type=int, default=1)
+    parser.add_argument('--peak', type=int, default=7000, help="Synthetic peak solar watts")
+    parser.add_argument('--clouds', type=float, default=0.0, help="0 for clear skies up to 1 for very cloudy")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--cars', type=int, default=1, help="How many cars on the account")
+    parser.add_argument('--soc', type=lambda text: [float(n) for n in text.split(',')], default=[50],
+                        help="Starting battery level, or one for each car: 50,30")
+    parser.add_argument('--limit', type=lambda text: [int(n) for n in text.split(',')], default=[90],
+                        help="Charge limit, or one for each car")
+    parser.add_argument('--split', choices=('priority', 'soc', 'proportional'), help="How the cars share the surplus")
+    parser.add_argument('--plugs', help="Kasa plugs to control as Name:watts,...")
+    parser.add_argument('--kasa', choices=('cloud', 'local'), default='cloud', help="Plugs through a fake TP-Link cloud, or TesKasa")
+    parser.add_argument('--record', help="SQLite file to record the simulated history in, for TesLog.py")
+    parser.add_argument('--forecast', help="JSON file for TesSense's surplus profile, it plans from it once a day is seen")
+    parser.add_argument('--state', help="JSON file for TesSense's tokens and cars' state, run twice to start from it")
+    parser.add_argument('--drive', type=float, default=0, help="SoC %% each car uses, gone at TesSense.DEPARTURE each day")
+    parser.add_argument('--poll', action='store_true', help="Poll Sense instead of streaming from it")
+    parser.add_argument('--drop', type=int, default=0, help="Seconds before Sense's websocket drops each time, 0 never")
+    parser.add_argument('--metrics', action='store_true', help="Print TesSense's metrics, in virtual seconds")
+    parser.add_argument('--verbose', action='store_true', help="Show TesSense's own output")
+    parser.add_argument('--log', choices=('tty', 'json'), default='tty', help="How --verbose shows it")
+    simulate(parser.parse_args())
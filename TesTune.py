@@ -0,0 +1,164 @@
+"""
+ TesTune - Backtest and tune TesSense's charging law on recorded history
+ Replays a CSV of epoch seconds, solar watts and house load watts through the
+ decisions in TesLaw.py for every combination of the settings given, spread
+ across all CPUs, and ranks them by solar energy that ended up in the car.
+ With numpy installed each process steps all of its settings at once.
+
+    python3 TesTune.py history.csv --minrate 2,3,5 --hysteresis 1,2,3 --smoothing 0,60,120,300
+    python3 TesTune.py history.csv --dwell 0,300,900 --soc 40 --limit 80 --top 5
+"""
+
+import argparse, csv, itertools, math, os, time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from TesLaw import Params, State, decide, settle, NIGHT, START, STOP
+
+try: import numpy as np                                     # pip3 install numpy (to step many settings at once)
+except ImportError: np = None
+
+CYCLE = 120                                                 # Seconds between TesSense decisions
+Car = namedtuple('Car', 'soc limit max_amps battery_kwh volts', defaults=(50, 90, 32, 75, 240))
+Result = namedtuple('Result', 'params solar_kwh grid_kwh commands')
+Trace = namedtuple('Trace', 't solar load hour day')
+
+
+def load(path, tz='US/Pacific', step=60):                   # Average the history into step second buckets
+    buckets = {}
+    with open(path) as f:
+        for row in csv.reader(f):
+            if not row or not row[0][:1].isdigit(): continue    # Skip headers
+            bucket = buckets.setdefault(int(float(row[0])) // step * step, [0, 0, 0])
+            bucket[0] += float(row[1]); bucket[1] += float(row[2]); bucket[2] += 1
+    zone, t, solar, load, hour, day = ZoneInfo(tz), [], [], [], [], []
+    for stamp in sorted(buckets):
+        total_solar, total_load, count = buckets[stamp]
+        local = datetime.fromtimestamp(stamp, zone)
+        t.append(stamp); solar.append(total_solar / count); load.append(total_load / count)
+        hour.append(local.hour); day.append(local.toordinal())
+    return Trace(t, solar, load, hour, day)
+
+
+def backtest(trace, p, car=Car()):                          # Step TesLaw itself over the history, one set of params
+    rate, charging, soc, changed, mean, decision = 0, False, car.soc, -math.inf, None, trace.t[0]
+    solar_kwh = grid_kwh = 0.0
+    commands, today = 0, trace.day[0]
+    for i, t in enumerate(trace.t):
+        dt = trace.t[i + 1] - t if i + 1 < len(trace.t) else 0
+        if trace.day[i] != today: today, soc = trace.day[i], car.soc   # Driven back down overnight
+        car_w = rate * car.volts if charging else 0
+        power_diff = trace.solar[i] - trace.load[i] - car_w   # What Sense sees
+        if mean is None or not p.smoothing: mean = power_diff
+        else: mean += (1 - math.exp(-(t - trace.t[i - 1]) / p.smoothing)) * (power_diff - mean)
+
+        if t >= decision:
+            decision = t + CYCLE
+            action = decide(State(trace.hour[i], charging, True, soc, car.limit, rate, car.max_amps,
+                                  power_diff, mean, car.volts), p)
+            if action == START:
+                charging, rate, changed, commands = True, 2, t, commands + 3
+            elif action == STOP or action == NIGHT and charging:
+                charging, rate, commands = False, 0, commands + 1
+            elif action.cmd == 'amps' and settle(action.amps, rate, t - changed, p):
+                rate, changed, commands = action.amps, t, commands + (2 if action.amps < 5 else 1)
+
+        car_w = rate * car.volts if charging else 0
+        from_solar = min(car_w, max(0, trace.solar[i] - trace.load[i]))
+        solar_kwh += from_solar * dt / 3.6e6
+        grid_kwh += (car_w - from_solar) * dt / 3.6e6
+        soc += car_w * dt / 36e3 / car.battery_kwh
+        if charging and soc >= car.limit: charging, rate = False, 0     # The car stops itself
+    return Result(p, solar_kwh, grid_kwh, commands)
+
+
+def backtest_grid(trace, grid, car=Car()):                  # The same steps as backtest() for every params at once
+    if np is None: return [backtest(trace, p, car) for p in grid]
+    column = lambda name: np.array([getattr(p, name) for p in grid], dtype=float)
+    minrate, hysteresis, dwell, smoothing = column('minrate'), column('hysteresis'), column('dwell'), column('smoothing')
+    until, after = column('sleep_until'), column('sleep_after')
+    size = len(grid)
+    rate, charging, soc = np.zeros(size), np.zeros(size, bool), np.full(size, float(car.soc))
+    changed, mean, commands = np.full(size, -np.inf), None, np.zeros(size)
+    solar_kwh, grid_kwh = np.zeros(size), np.zeros(size)
+    decision, today, smoothed = trace.t[0], trace.day[0], smoothing > 0
+    window = np.where(smoothed, smoothing, 1)
+
+    for i, t in enumerate(trace.t):
+        dt = trace.t[i + 1] - t if i + 1 < len(trace.t) else 0
+        if trace.day[i] != today: today = trace.day[i]; soc[:] = car.soc
+        free = trace.solar[i] - trace.load[i]
+        power_diff = free - np.where(charging, rate * car.volts, 0)
+        if mean is None: mean = power_diff.copy()
+        else:
+            alpha = np.where(smoothed, 1 - np.exp(-(t - trace.t[i - 1]) / window), 1)
+            mean += alpha * (power_diff - mean)
+
+        if t >= decision:
+            decision = t + CYCLE
+            day = (until <= trace.hour[i]) & (trace.hour[i] < after)
+            start = ~charging & day & (power_diff > minrate * car.volts) & (soc < car.limit)
+            newrate = np.minimum(rate + np.trunc(mean / car.volts), car.max_amps)
+            stop = charging & (~day | (newrate < minrate))
+            change = charging & ~stop & (newrate != rate) & (np.abs(newrate - rate) >= hysteresis) & \
+                     ((newrate < rate) | (t - changed >= dwell))
+            commands += 3 * start + stop + change * np.where(newrate < 5, 2, 1)
+            rate = np.where(change, newrate, rate)
+            changed = np.where(change | start, t, changed)
+            rate = np.where(start, 2, np.where(stop, 0, rate))
+            charging = (charging & ~stop) | start
+
+        car_w = np.where(charging, rate * car.volts, 0)
+        from_solar = np.minimum(car_w, max(0, free))
+        solar_kwh += from_solar * dt / 3.6e6
+        grid_kwh += (car_w - from_solar) * dt / 3.6e6
+        soc += car_w * dt / 36e3 / car.battery_kwh
+        done = charging & (soc >= car.limit)                # The car stops itself
+        charging, rate = charging & ~done, np.where(done, 0, rate)
+    return [Result(p, float(s), float(g), int(c)) for p, s, g, c in zip(grid, solar_kwh, grid_kwh, commands)]
+
+
+def sweep(trace, grid, car=Car(), workers=None):            # Split the grid over a process pool
+    workers = min(workers or os.cpu_count() or 1, len(grid))
+    chunks = [grid[n::workers] for n in range(workers)]
+    with ProcessPoolExecutor(workers) as pool:
+        return [result for chunk in pool.map(backtest_grid, [trace] * workers, chunks, [car] * workers) for result in chunk]
+
+def numbers(text): return [float(n) if '.' in n else int(n) for n in text.split(',')]
+
+if __name__ == "__main__":
+    defaults = Params()
+    parser = argparse.ArgumentParser(description="Backtest TesSense's charging law over recorded solar and load")
+    parser.add_argument('history', help="CSV of epoch seconds, solar watts, load watts")
+    parser.add_argument('--minrate', type=numbers, default=[defaults.minrate])
+    parser.add_argument('--hysteresis', type=numbers, default=[defaults.hysteresis])
+    parser.add_argument('--dwell', type=numbers, default=[defaults.dwell])
+    parser.add_argument('--smoothing', type=numbers, default=[defaults.smoothing])
+    parser.add_argument('--window', default="%d-%d" % (defaults.sleep_until, defaults.sleep_after), help="Charging hours, 8-20")
+    parser.add_argument('--soc', type=float, default=Car().soc, help="Battery level each morning")
+    parser.add_argument('--limit', type=int, default=Car().limit)
+    parser.add_argument('--step', type=int, default=60, help="Seconds to average the history into")
+    parser.add_argument('--tz', default='US/Pacific')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--cmd-cost', type=float, default=.01, help="kWh a command is worth when ranking")
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    began = time.perf_counter()
+    trace = load(args.history, args.tz, args.step)
+    until, after = map(int, args.window.split('-'))
+    grid = [Params(*combo, sleep_until=until, sleep_after=after) for combo in
+            itertools.product(args.minrate, args.hysteresis, args.dwell, args.smoothing)]
+    results = sweep(trace, grid, Car(args.soc, args.limit), args.workers)
+    results.sort(key=lambda r: r.solar_kwh - r.grid_kwh - r.commands * args.cmd_cost, reverse=True)
+
+    days = len(set(trace.day))
+    print(len(grid), "settings over", days, "days in", round(time.perf_counter() - began, 1), "seconds",
+          "" if np else "(install numpy to go faster)")
+    print("minrate hysteresis dwell smoothing   solar kWh  grid kWh  commands/day")
+    for r in results[:args.top]:
+        p = r.params
+        print("%7s %10s %5s %9s %11.1f %9.1f %13.1f" % (p.minrate, p.hysteresis, p.dwell, p.smoothing,
+              r.solar_kwh, r.grid_kwh, r.commands / days))